@@ -13,6 +13,18 @@ EMAIL_ADDRESSES = {
         'folder': '<FOLDER_NAME_HERE>',
         'secret_id': '<SECRET_ID_HERE>'
     },
+    'inbox_with_large_backlog': {
+        'email': 'inbox3@vwtelecom.com',
+        'secret_id': '<SECRET_ID_HERE>',
+        'mark_as_read_batch_size': 25,
+        'look_ahead': 10,
+        'page_size': 10
+    },
+    'inbox_with_incremental_sync': {
+        'email': 'inbox4@vwtelecom.com',
+        'secret_id': '<SECRET_ID_HERE>',
+        'incremental_sync': True
+    },
     'inbox_with_oauth': {
         'email': 'inbox2@vwtelecom.com',
         'folder': '<FOLDER_NAME_HERE>',
@@ -22,16 +34,49 @@ EMAIL_ADDRESSES = {
     }
 }
 
+MAILBOX_GROUPS = {
+    'low_volume': ['inbox1', 'inbox_with_alias']
+}
+MAILBOX_CONCURRENCY = 4
+MAILBOX_TIME_BUDGET = 120
+
+FUNCTION_TIMEOUT = 540
+FUNCTION_TIMEOUT_MARGIN = 30
+
+WORKER_POLL_INTERVAL = 5
+WORKER_RECONNECT_DELAY = 30
+WORKER_SUBSCRIPTION_TIMEOUT = 10
+
 EXCHANGE_URL = 'https://outlook.office365.com/ews/exchange.asmx'
 EXCHANGE_VERSION = {'major': 15, 'minor': 20}
+EWS_MAX_REQUEST_RATE = 10
+EWS_MAX_WAIT = 60
 
 PROJECT_ID = '<PROJECT_ID>'
 BUCKET_NAME = '<BUCKET_NAME>'
 TOPIC_NAME = '<TOPIC_NAME>'
+STATE_BUCKET = '<STATE_BUCKET_NAME>'
+SYNC_MAX_CHANGES = 512
+IDEMPOTENCY = True
 
 ATTACHMENTS_TO_STORE = ['application/pdf']
+ATTACHMENT_UPLOAD_WORKERS = 4
+ATTACHMENT_DEDUPLICATION = 'reference'
+ATTACHMENT_SPOOL_MAX_BYTES = 1024 * 1024
+ATTACHMENT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+BODY_OFFLOAD_SIZE = 256 * 1024
+BODY_OFFLOAD_COMPRESSION = 'gzip'
+
+PDF_CLEAN_WORKERS = 2
+PDF_CLEAN_MAX_BYTES = 50 * 1024 * 1024
+PDF_CLEAN_TIMEOUT = 60
+PDF_CLEAN_FALLBACK = 'reject'
 
 ALLOWED_HTML_BODY_TAGS = ['html-tag1', 'html-tag2']
 
 ERROR_EMAIL_ADDRESS = 'support@vwtelecom.com'
 ERROR_EMAIL_MESSAGE = 'This is an error message'
+
+PROCESSING_WORKERS = 4
+PUBSUB_BATCH_SETTINGS = {'max_messages': 100, 'max_latency': 0.05}
@@ -0,0 +1,243 @@
+"""
+In-process stand-ins for EWS, GCS and Pub/Sub with injected latency, so the real pipeline can be benchmarked offline.
+"""
+import io
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Lock
+
+from exchangelib import FileAttachment
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+
+def _sleep(seconds: float):
+    if seconds:
+        time.sleep(seconds)
+
+
+class FakeAttachmentIO:
+    """
+    The content of an attachment, which is only retrieved (GetAttachment) when it is opened.
+    """
+
+    def __init__(self, data: bytes, latency: float):
+        self._data = data
+        self._latency = latency
+        self._fp = None
+
+    def __enter__(self):
+        _sleep(self._latency)
+        self._fp = io.BytesIO(self._data)
+        return self._fp
+
+    def __exit__(self, *_):
+        self._fp.close()
+
+
+class FakeFileAttachment(FileAttachment):
+    __slots__ = ('_fake_data', '_fake_latency')
+
+    def __init__(self, data: bytes, latency: float = 0, **kwargs):
+        super().__init__(size=len(data), is_inline=False, **kwargs)
+        self._fake_data = data
+        self._fake_latency = latency
+
+    @property
+    def fp(self):
+        return FakeAttachmentIO(self._fake_data, self._fake_latency)
+
+
+class FakeSender:
+    def __init__(self, email_address: str):
+        self.email_address = email_address
+
+
+class FakeMessage:
+    def __init__(self, item_id, subject, sender, datetime_sent, datetime_received, unique_body, attachments,
+                 latency=0):
+        self.id = item_id
+        self.changekey = 'changekey'
+        self.message_id = '<{}@benchmark.example.com>'.format(item_id)
+        self.subject = subject
+        self.sender = FakeSender(sender)
+        self.datetime_sent = datetime_sent
+        self.datetime_received = datetime_received
+        self.unique_body = unique_body
+        self.attachments = attachments
+        self.is_read = False
+        self.latency = latency
+
+    def save(self, update_fields=None):
+        _sleep(self.latency)
+
+    def forward(self, subject, body, to_recipients):
+        _sleep(self.latency)
+
+
+class FakeQuery:
+    def __init__(self, folder):
+        self._folder = folder
+        self.page_size = 100
+
+    def order_by(self, *args):
+        return self
+
+    def values_list(self, *args):
+        return self
+
+    def iterator(self):
+        messages = [message for message in self._folder.messages if not message.is_read]
+        for index, message in enumerate(messages):
+            if index % self.page_size == 0:
+                # FindItem with the ids of a page of messages.
+                _sleep(self._folder.latency)
+            yield message.id, message.changekey
+
+
+class FakeFolder:
+    def __init__(self, messages, latency=0):
+        self.messages = messages
+        self.latency = latency
+
+    @property
+    def unread_count(self):
+        return sum(1 for message in self.messages if not message.is_read)
+
+    def refresh(self):
+        _sleep(self.latency)
+
+    def filter(self, **kwargs):
+        return FakeQuery(self)
+
+
+class FakeAccount:
+    def __init__(self, folder: FakeFolder):
+        self.inbox = folder
+
+    def fetch(self, ids, folder=None, only_fields=None, chunk_size=None):
+        messages = {message.id: message for message in self.inbox.messages}
+        for index, (item_id, _) in enumerate(ids):
+            if index % (chunk_size or 100) == 0:
+                # GetItem with the requested fields of a page of messages.
+                _sleep(self.inbox.latency)
+            yield messages[item_id]
+
+    def bulk_update(self, items, chunk_size=None):
+        results = []
+        for index, (message, fields) in enumerate(items):
+            if index % (chunk_size or 100) == 0:
+                _sleep(self.inbox.latency)
+            results.append((message.id, message.changekey))
+        return results
+
+
+class FakeGCSSession:
+    """
+    Handles the requests of google-resumable-media uploads the way the GCS JSON API does.
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.objects = {}
+        self._sessions = {}
+        self._session_ids = count()
+        self._lock = Lock()
+
+    @staticmethod
+    def _response(status_code: int, headers: dict = None, content: dict = None) -> Response:
+        response = Response()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers or {})
+        response._content = json.dumps(content or {}).encode('utf-8')
+        return response
+
+    def request(self, method, url, data=None, headers=None, timeout=None, **kwargs):
+        _sleep(self.latency)
+
+        if 'uploadType=multipart' in url:
+            # The metadata part is followed by the content part.
+            name = json.loads(re.search(rb'\r\n\r\n({.*?})\r\n', data).group(1))['name']
+            with self._lock:
+                self.objects[name] = len(data)
+            return self._response(200, content={'name': name})
+
+        if 'uploadType=resumable' in url:
+            name = json.loads(data)['name']
+            with self._lock:
+                session_id = str(next(self._session_ids))
+                self._sessions[session_id] = [name, 0]
+            return self._response(200, headers={'location': 'https://fake.example.com/upload/' + session_id})
+
+        session_id = url.rsplit('/', 1)[1]
+        with self._lock:
+            session = self._sessions[session_id]
+            session[1] += len(data)
+
+        total = headers['content-range'].rsplit('/', 1)[1]
+        if total != '*' and int(total) == session[1]:
+            with self._lock:
+                self.objects[session[0]] = session[1]
+            return self._response(200, content={'name': session[0], 'size': total})
+
+        return self._response(308, headers={'range': 'bytes=0-{}'.format(session[1] - 1)})
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def exists(self):
+        return self.name in self.bucket.session.objects
+
+
+class FakeBucket:
+    def __init__(self, name, session: FakeGCSSession):
+        self.name = name
+        self.session = session
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def copy_blob(self, blob, destination_bucket, new_name, **kwargs):
+        _sleep(self.session.latency)
+        self.session.objects[new_name] = self.session.objects[blob.name]
+
+
+class FakeStorageClient:
+    _credentials = None
+
+    def __init__(self, session: FakeGCSSession):
+        self.session = session
+
+    def bucket(self, name):
+        return FakeBucket(name, self.session)
+
+
+class FakePublisherClient:
+    """
+    Publishes messages asynchronously, resolving their futures after the injected latency.
+    """
+
+    def __init__(self, latency: float = 0, workers: int = 10):
+        self.latency = latency
+        self.messages = []
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fake-publish')
+        self._message_ids = count()
+        self._lock = Lock()
+
+    def _publish(self, data):
+        _sleep(self.latency)
+        with self._lock:
+            self.messages.append(data)
+            return str(next(self._message_ids))
+
+    def publish(self, topic, data):
+        return self._executor.submit(self._publish, data)
+
+    def shutdown(self):
+        self._executor.shutdown()
@@ -0,0 +1,99 @@
+"""
+Generates synthetic mailboxes for the benchmarks.
+"""
+import io
+import random
+from datetime import datetime, timedelta, timezone
+
+import pikepdf
+
+from benchmarks.fakes import FakeFileAttachment, FakeMessage
+
+
+def generate_pdf(size: int, rng: random.Random) -> bytes:
+    """
+    :return: a valid PDF of roughly the given number of bytes, with a page per 64 KiB of content.
+    """
+    pdf = pikepdf.new()
+    pages = max(1, size // (64 * 1024))
+    for _ in range(pages):
+        operators = []
+        length = 0
+        while length < size // pages:
+            operators.append('{} {} m {} {} l S\n'.format(*(rng.randrange(612) for _ in range(4))).encode('ascii'))
+            length += len(operators[-1])
+        page = pdf.add_blank_page(page_size=(612, 792))
+        page.Contents = pdf.make_stream(b''.join(operators))
+
+    output = io.BytesIO()
+    pdf.save(output, compress_streams=False)
+    return output.getvalue()
+
+
+def generate_xml(size: int, rng: random.Random) -> bytes:
+    """
+    :return: an XML document with a namespace, of roughly the given number of bytes.
+    """
+    lines = [b'<?xml version="1.0" encoding="utf-8"?>\n', b'<invoice xmlns="urn:example:invoice">\n']
+    length = sum(len(line) for line in lines)
+    while length < size:
+        line = '  <line number="{}"><amount>{:.2f}</amount></line>\n'.format(
+            rng.randrange(10000), rng.random() * 1000).encode('ascii')
+        lines.append(line)
+        length += len(line)
+    lines.append(b'</invoice>\n')
+    return b''.join(lines)
+
+
+def generate_body(size: int, rng: random.Random) -> str:
+    words = ['invoice', 'order', 'delivery', 'attached', 'regards', 'please', 'find', 'the']
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = '<p>{}</p><b>{}</b><script>alert(1)</script>'.format(
+            ' '.join(rng.choice(words) for _ in range(40)), rng.choice(words))
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return '<html><body>{}</body></html>'.format(''.join(paragraphs))[:max(size, 1)]
+
+
+def generate_mailbox(emails: int = 100, body_size: int = 4 * 1024, pdf_attachments: int = 1,
+                     pdf_size: int = 100 * 1024, xml_attachments: int = 0, xml_size: int = 50 * 1024,
+                     distinct_attachments: int = None, attachment_latency: float = 0, message_latency: float = 0,
+                     seed: int = 0) -> list:
+    """
+    :param distinct_attachments: number of distinct contents per attachment type, so attachments repeat across
+        emails like recurring invoices do. Every attachment is unique when not given.
+    :return: FakeMessages with the given number of PDF and XML attachments.
+    """
+    rng = random.Random(seed)
+    received = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    contents = {}
+
+    def get_content(kind, generate, size, number):
+        key = (kind, number % distinct_attachments if distinct_attachments else number)
+        if key not in contents:
+            contents[key] = generate(size, rng)
+        return contents[key]
+
+    messages = []
+    attachment_number = 0
+    for number in range(emails):
+        attachments = []
+        for index in range(pdf_attachments):
+            attachment_number += 1
+            attachments.append(FakeFileAttachment(get_content('pdf', generate_pdf, pdf_size, attachment_number),
+                                                  attachment_latency, name='invoice-{}.pdf'.format(index),
+                                                  content_type='application/pdf'))
+        for index in range(xml_attachments):
+            attachment_number += 1
+            attachments.append(FakeFileAttachment(get_content('xml', generate_xml, xml_size, attachment_number),
+                                                  attachment_latency, name='invoice-{}.xml'.format(index),
+                                                  content_type='application/xml'))
+
+        messages.append(FakeMessage('item-{}'.format(number), 'Benchmark e-mail {}'.format(number),
+                                    'sender@example.com', received + timedelta(minutes=number),
+                                    received + timedelta(minutes=number, seconds=5),
+                                    generate_body(body_size, rng), attachments, latency=message_latency))
+
+    return messages
@@ -0,0 +1,181 @@
+"""
+Runs the pipeline of main.handler against a synthetic mailbox, with EWS, GCS and Pub/Sub replaced by in-process
+fakes with injected latency, and reports the throughput, peak memory and time per stage.
+
+Usage, from the function directory: python -m benchmarks.run --emails 200 --ews-latency 0.05 --output results.jsonl
+"""
+import argparse
+import json
+import logging
+import platform
+import resource
+import subprocess  # nosec
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from unittest import mock
+
+import config
+import mail
+import main
+import publish
+import storage.base
+from benchmarks.fakes import FakeAccount, FakeFolder, FakeGCSSession, FakePublisherClient, FakeStorageClient
+from benchmarks.mailbox import generate_mailbox
+from metrics import metrics
+from storage.deduplication import AttachmentIndex
+from storage.email_attachment_storage import EmailAttachmentStorageService
+
+BENCHMARK_IDENTIFIER = 'benchmark'
+BENCHMARK_EMAIL_ADDRESS = 'benchmark@example.com'
+BENCHMARK_BUCKET_NAME = 'benchmark-bucket'
+BENCHMARK_ATTACHMENTS_TO_STORE = ['application/pdf', 'application/xml']
+
+
+class BenchmarkRequest:
+    method = 'POST'
+    data = b'{}'
+    headers = {}
+
+    def __init__(self, args: dict):
+        self.args = args
+
+
+def _get_peak_rss(baseline_kib: int) -> dict:
+    # ru_maxrss is in KiB on Linux. Worker processes are only included once they have exited.
+    return {'self_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'baseline_kib': baseline_kib,
+            'children_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def _get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,  # nosec
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(emails: int = 100, body_size: int = 4 * 1024, pdf_attachments: int = 1,
+                  pdf_size: int = 100 * 1024, xml_attachments: int = 0, xml_size: int = 50 * 1024,
+                  distinct_attachments: int = None, ews_latency: float = 0, attachment_latency: float = 0,
+                  gcs_latency: float = 0, publish_latency: float = 0, processing_workers: int = None,
+                  pubsub_batch_settings: dict = None, attachment_deduplication: str = None,
+                  mailbox_options: dict = None) -> dict:
+    """
+    Processes a generated mailbox with main.handler.
+
+    :param attachment_deduplication: see ATTACHMENT_DEDUPLICATION, the index is only kept in memory.
+    :param mailbox_options: optional mailbox fields, e.g. {'mark_as_read_batch_size': 50, 'look_ahead': 10}.
+    :return: the parameters and results of the run.
+    """
+    parameters = {
+        'emails': emails, 'body_size': body_size, 'pdf_attachments': pdf_attachments, 'pdf_size': pdf_size,
+        'xml_attachments': xml_attachments, 'xml_size': xml_size, 'distinct_attachments': distinct_attachments,
+        'ews_latency': ews_latency, 'attachment_latency': attachment_latency, 'gcs_latency': gcs_latency,
+        'publish_latency': publish_latency, 'processing_workers': processing_workers,
+        'pubsub_batch_settings': pubsub_batch_settings, 'attachment_deduplication': attachment_deduplication,
+        'mailbox_options': mailbox_options or {}
+    }
+
+    # The mailbox is generated up front, so it is not part of the measurement.
+    messages = generate_mailbox(emails, body_size, pdf_attachments, pdf_size, xml_attachments, xml_size,
+                                distinct_attachments, attachment_latency, ews_latency)
+    folder = FakeFolder(messages, latency=ews_latency)
+    gcs_session = FakeGCSSession(latency=gcs_latency)
+    publisher = FakePublisherClient(latency=publish_latency)
+
+    credentials = dict(mailbox_options or {}, email=BENCHMARK_EMAIL_ADDRESS)
+    cache_key = (BENCHMARK_EMAIL_ADDRESS, None, mail._get_credentials_fingerprint(None, None, None, None))
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(mail._exchange_clients, {cache_key: (FakeAccount(folder), folder)}))
+        stack.enter_context(mock.patch.object(main, 'EMAIL_ADDRESSES', {BENCHMARK_IDENTIFIER: credentials}))
+        stack.enter_context(mock.patch.object(main, 'PROCESSING_WORKERS', processing_workers))
+        stack.enter_context(mock.patch.object(main, 'PUBSUB_BATCH_SETTINGS', pubsub_batch_settings))
+        stack.enter_context(mock.patch.object(config, 'ATTACHMENTS_TO_STORE', BENCHMARK_ATTACHMENTS_TO_STORE))
+        stack.enter_context(mock.patch.object(publish, 'ATTACHMENTS_TO_STORE', BENCHMARK_ATTACHMENTS_TO_STORE))
+        stack.enter_context(mock.patch('google.cloud.pubsub_v1.PublisherClient', return_value=publisher))
+        stack.enter_context(mock.patch.object(storage.base.storage, 'Client',
+                                              return_value=FakeStorageClient(gcs_session)))
+        stack.enter_context(mock.patch.object(storage.base, 'AuthorizedSession', return_value=gcs_session))
+        storage_service = EmailAttachmentStorageService(BENCHMARK_BUCKET_NAME, attachment_deduplication,
+                                                        AttachmentIndex() if attachment_deduplication else None)
+        stack.enter_context(mock.patch.object(main, '_storage_service', storage_service))
+
+        # The peak before the run includes the generated mailbox, the run only raises it above this baseline.
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = metrics.snapshot()
+        started_at = time.monotonic()
+        main.handler(BenchmarkRequest({'identifier': BENCHMARK_IDENTIFIER}))
+        seconds = time.monotonic() - started_at
+        summary = metrics.summarize(started)
+
+    publisher.shutdown()
+    # Measured before forking git, whose peak RSS would include that of this process.
+    peak_rss = _get_peak_rss(baseline_rss)
+
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'revision': _get_revision(),
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'seconds': round(seconds, 6),
+        'emails_per_second': round(emails / seconds, 3) if seconds else None,
+        'emails_published': len(publisher.messages),
+        'emails_read': sum(1 for message in messages if message.is_read),
+        'objects_uploaded': len(gcs_session.objects),
+        'peak_rss': peak_rss,
+        'stages': summary['stages'],
+        'counters': summary['counters']
+    }
+
+
+def _format_report(result: dict) -> str:
+    header = ('{emails_published} e-mail(s) in {seconds:.2f}s: {emails_per_second} e-mails/s, peak RSS {self_kib} KiB '
+              '(before the run {baseline_kib} KiB, worker processes {children_kib} KiB)')
+    lines = [header.format(**result, **result['peak_rss'])]
+    for stage, timer in sorted(result['stages'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append('  {:<50} {:>8} x {:>10.3f}s'.format(stage, timer['count'], timer['seconds']))
+    return '\n'.join(lines)
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline against a synthetic mailbox.')
+    parser.add_argument('--emails', type=int, default=100)
+    parser.add_argument('--body-size', type=int, default=4 * 1024, help='bytes of the HTML body of an e-mail')
+    parser.add_argument('--pdf-attachments', type=int, default=1, help='PDF attachments per e-mail')
+    parser.add_argument('--pdf-size', type=int, default=100 * 1024, help='bytes of a PDF attachment')
+    parser.add_argument('--xml-attachments', type=int, default=0, help='XML attachments per e-mail')
+    parser.add_argument('--xml-size', type=int, default=50 * 1024, help='bytes of an XML attachment')
+    parser.add_argument('--distinct-attachments', type=int, default=None,
+                        help='distinct contents per attachment type, all attachments are unique when not given')
+    parser.add_argument('--ews-latency', type=float, default=0,
+                        help='seconds per EWS request (a page of e-mails, saving or forwarding an e-mail)')
+    parser.add_argument('--attachment-latency', type=float, default=0, help='seconds to retrieve an attachment')
+    parser.add_argument('--gcs-latency', type=float, default=0, help='seconds per GCS request')
+    parser.add_argument('--publish-latency', type=float, default=0, help='seconds until a publish completes')
+    parser.add_argument('--processing-workers', type=int, default=None)
+    parser.add_argument('--pubsub-batch-settings', type=json.loads, default=None,
+                        help='JSON, e.g. \'{"max_messages": 100, "max_latency": 0.05}\'')
+    parser.add_argument('--attachment-deduplication', choices=('reference', 'copy'), default=None)
+    parser.add_argument('--mailbox-options', type=json.loads, default=None,
+                        help='JSON with optional mailbox fields, e.g. \'{"mark_as_read_batch_size": 50}\'')
+    parser.add_argument('--output', help='file the result is appended to as a JSON line, to track it over time')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = run_benchmark(args.emails, args.body_size, args.pdf_attachments, args.pdf_size, args.xml_attachments,
+                           args.xml_size, args.distinct_attachments, args.ews_latency, args.attachment_latency,
+                           args.gcs_latency, args.publish_latency, args.processing_workers,
+                           args.pubsub_batch_settings, args.attachment_deduplication, args.mailbox_options)
+
+    print(_format_report(result))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main_cli()
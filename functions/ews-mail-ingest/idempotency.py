@@ -0,0 +1,85 @@
+import logging
+
+import config
+from mail import Email
+from state_store import StateStore, get_state_store
+
+# Whether the completed stages of processing an e-mail are recorded in the state store, so a next run does not
+# store or publish an e-mail again that failed to be marked as read.
+IDEMPOTENCY = getattr(config, 'IDEMPOTENCY', False)
+
+STORED = 'stored'
+PUBLISHED = 'published'
+
+
+class EmailProgress:
+    """
+    The stages of processing an email that are done, which retries of the email skip.
+    """
+
+    def __init__(self, email: Email, state_store: StateStore = None, key: str = None, stages: dict = None):
+        self.email = email
+        self.stages = stages or {}
+        self.attempts = 0
+        self._state_store = state_store
+        self._key = key
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def _complete(self, stage: str, value=True):
+        self.stages[stage] = value
+        if self._state_store is not None:
+            self._state_store.save(self._key, self.stages)
+
+    def complete_storing(self):
+        self._complete(STORED, [[index, attachment.storage_bucket, attachment.storage_filename]
+                                for index, attachment in enumerate(self.email.attachments)
+                                if attachment.storage_filename is not None])
+
+    def restore_stored_attachments(self):
+        """
+        Sets the storage locations of the attachments that were stored by an earlier attempt.
+        """
+        for index, bucket, filename in self.stages.get(STORED, []):
+            self.email.attachments[index].storage_bucket = bucket
+            self.email.attachments[index].storage_filename = filename
+
+    def complete_publishing(self):
+        self._complete(PUBLISHED)
+
+
+class IdempotencyStore:
+    """
+    Keeps the progress of emails by mailbox identifier and email uuid, which is derived from the Internet Message-ID.
+    Without a state store the progress is only kept by the EmailProgress itself, e.g. for retries in the same run.
+    """
+
+    def __init__(self, state_store: StateStore = None, prefix: str = 'emails/'):
+        self._state_store = state_store
+        self._prefix = prefix
+
+    def get_progress(self, email: Email, identifier: str) -> EmailProgress:
+        if self._state_store is None:
+            return EmailProgress(email)
+
+        key = '{}{}/{}'.format(self._prefix, identifier, email.uuid)
+        stages = self._state_store.load(key)
+        if stages:
+            logging.info('Resuming email {} after stage(s) {}'.format(email.uuid, ', '.join(stages)))
+
+        return EmailProgress(email, self._state_store, key, stages)
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """
+    :return: an IdempotencyStore that uses the state store when IDEMPOTENCY is enabled.
+    """
+    if not IDEMPOTENCY:
+        return IdempotencyStore()
+
+    state_store = get_state_store()
+    if state_store is None:
+        raise ValueError('IDEMPOTENCY requires STATE_BUCKET or STATE_DIRECTORY.')
+
+    return IdempotencyStore(state_store)
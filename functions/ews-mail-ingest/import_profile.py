@@ -0,0 +1,133 @@
+"""
+Times the imports of the function when the IMPORT_PROFILE environment variable is set.
+
+python -X importtime can't be passed to a deployed function, so imports are timed by wrapping builtins.__import__.
+Modules that are imported on first use are included in the profile of the invocation that loads them.
+"""
+import builtins
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+from threading import Lock, local
+
+# Number of modules that are reported, by the time spent importing the module itself.
+IMPORT_PROFILE_LIMIT = 25
+
+_original_import = builtins.__import__
+_imports = local()
+# Self and cumulative seconds per module, since the last report.
+_modules = {}
+_total_seconds = 0.0
+_lock = Lock()
+
+
+def _get_loaded_module(name: str, globals_: dict, fromlist, level: int):
+    """
+    :return: the name of the module an import statement will load, or None if it's already loaded.
+    """
+    try:
+        if level:
+            name = importlib.util.resolve_name('.' * level + name, (globals_ or {}).get('__package__'))
+    except (ImportError, ValueError):
+        # The import itself raises the error.
+        return None
+
+    module = sys.modules.get(name)
+    if module is None:
+        return name
+
+    # "from package import submodule" loads the submodule.
+    for item in fromlist or ():
+        if item != '*' and not hasattr(module, item):
+            return '{}.{}'.format(name, item)
+
+    return None
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _total_seconds
+
+    module_name = _get_loaded_module(name, globals, fromlist, level)
+    if module_name is None:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    stack = getattr(_imports, 'stack', None)
+    if stack is None:
+        stack = _imports.stack = []
+
+    # Seconds spent on the imports of this module are added to its entry on the stack.
+    stack.append(0.0)
+    started_at = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        seconds = time.perf_counter() - started_at
+        nested_seconds = stack.pop()
+
+        with _lock:
+            self_seconds, cumulative_seconds = _modules.get(module_name, (0.0, 0.0))
+            _modules[module_name] = (self_seconds + seconds - nested_seconds, cumulative_seconds + seconds)
+            if stack:
+                stack[-1] += seconds
+            else:
+                _total_seconds += seconds
+
+
+def enable():
+    builtins.__import__ = _profiled_import
+
+
+def disable():
+    builtins.__import__ = _original_import
+
+
+def is_enabled() -> bool:
+    return builtins.__import__ is _profiled_import
+
+
+def get_profile(limit: int = IMPORT_PROFILE_LIMIT, reset: bool = False) -> dict:
+    """
+    :return: the total seconds spent importing and the modules that took longest to import themselves.
+    """
+    global _total_seconds
+
+    with _lock:
+        modules, total_seconds = dict(_modules), _total_seconds
+        if reset:
+            _modules.clear()
+            _total_seconds = 0.0
+
+    slowest = sorted(modules.items(), key=lambda item: -item[1][0])[:limit]
+    return {
+        'seconds': round(total_seconds, 6),
+        'modules': [{'module': module, 'self_seconds': round(self_seconds, 6),
+                     'cumulative_seconds': round(cumulative_seconds, 6)}
+                    for module, (self_seconds, cumulative_seconds) in slowest]
+    }
+
+
+def report_imports():
+    """
+    Logs the profile of the imports since the last report, if there were any.
+    """
+    profile = get_profile(reset=True)
+    if profile['modules']:
+        logging.info(json.dumps({'message': 'Import profile', 'imports': profile}))
+
+
+if os.environ.get('IMPORT_PROFILE'):
+    enable()
+
+
+if __name__ == '__main__':
+    # Profiles the cold start of the function: python import_profile.py
+    enable()
+    started_at = time.perf_counter()
+    import main  # noqa: F401, E402
+
+    print('Imported main in {:.3f}s'.format(time.perf_counter() - started_at))
+    for entry in get_profile()['modules']:
+        print('{self_seconds:>10.3f}s {cumulative_seconds:>10.3f}s  {module}'.format(**entry))
@@ -1,3 +1,6 @@
+import sys
+
+import config
 from config import EMAIL_ADDRESSES
 
 
@@ -6,5 +9,13 @@ def print_email_identifiers():
     print(' '.join(email_identifiers))
 
 
+def print_mailbox_groups():
+    mailbox_groups = [key for key, value in getattr(config, 'MAILBOX_GROUPS', {}).items()]
+    print(' '.join(mailbox_groups))
+
+
 if __name__ == '__main__':
-    print_email_identifiers()
+    if '--groups' in sys.argv[1:]:
+        print_mailbox_groups()
+    else:
+        print_email_identifiers()
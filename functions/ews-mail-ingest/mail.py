@@ -1,22 +1,73 @@
-from exchangelib.errors import AutoDiscoverFailed, RateLimitError, ErrorServerBusy
+from exchangelib.errors import AutoDiscoverFailed
 from urllib3.exceptions import ReadTimeoutError
 
 import config
+import hashlib
 import logging
+import mimetypes
 from retry import retry
 
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Any
-from uuid import uuid4
+from queue import Queue, Full
+from threading import Event, Lock, Thread
+from typing import List, Any, Iterator
+from uuid import NAMESPACE_URL, uuid5
 
-from exchangelib import Credentials, Configuration, Account, FaultTolerance, Build, Version, FileAttachment, Message, \
+from exchangelib import Credentials, Configuration, Account, Build, Version, FileAttachment, Message, \
     OAuth2Credentials, OAUTH2, BASIC, IMPERSONATION
 from exchangelib.folders import Messages
+from exchangelib.items import ID_ONLY
+from exchangelib.services import SyncFolderItems
+
+from metrics import metrics
+from ratelimit import RateLimitedRetryPolicy, get_rate_limiter
 
 # Suppress warnings from exchangelib
 logging.getLogger("exchangelib").setLevel(logging.WARN)
 
+_END_OF_STREAM = object()
+
+# Initialized accounts and their folder, reused across warm invocations.
+# Keyed by mailbox, folder and a fingerprint of the credentials.
+_exchange_clients = {}
+
+
+def _get_credentials_fingerprint(*credentials) -> str:
+    return hashlib.sha256(repr(credentials).encode('utf-8')).hexdigest()
+
+
+MESSAGE_FIELDS = ('message_id', 'subject', 'sender', 'received_by', 'datetime_sent', 'datetime_received',
+                  'unique_body', 'attachments', 'is_read')
+
+# Namespace of the uuids of e-mails, which are derived from their mailbox and Internet Message-ID.
+_EMAIL_UUID_NAMESPACE = uuid5(NAMESPACE_URL, 'https://github.com/vwt-digital/ews-mail-ingest')
+
+# Upper bound of the page size that is derived from the number of unread e-mails.
+MAX_ADAPTIVE_PAGE_SIZE = 25
+# Number of ids of unread e-mails that are listed per FindItem request, the maximum of EWS.
+UNREAD_ID_PAGE_SIZE = 1000
+
+# Maximum number of folder changes an incremental sync retrieves per run, EWS allows at most 512. The remaining
+# changes are retrieved by the next runs, so the first sync of a large folder is spread over several runs.
+SYNC_MAX_CHANGES = getattr(config, 'SYNC_MAX_CHANGES', 512)
+
+
+def get_storable_content_type(name: str, content_type: str):
+    """
+    :return: the content-type an attachment is stored with, or None if the attachment is not stored.
+    """
+    if content_type in config.ATTACHMENTS_TO_STORE:
+        return content_type
+
+    # Sometimes the mimetype of a file is application/octet-stream,
+    # while the file itself is actually a different type.
+    guessed_content_type = mimetypes.guess_type(name)[0]
+    if content_type == 'application/octet-stream' and guessed_content_type in config.ATTACHMENTS_TO_STORE:
+        return guessed_content_type
+
+    return None
+
 
 @dataclass
 class Attachment:
@@ -29,6 +80,8 @@ class Attachment:
     storage_bucket: str
     storage_filename: str
 
+    size: int = None
+
 
 @dataclass
 class Email:
@@ -55,6 +108,16 @@ class EmailService:
     def retrieve_unread_emails(self) -> List[Email]:
         pass
 
+    def stream_unread_emails(self, look_ahead: int = None) -> Iterator[Email]:
+        return iter(self.retrieve_unread_emails())
+
+    def acknowledge(self, email: Email) -> List[Email]:
+        email.mark_as_read()
+        return []
+
+    def flush_acknowledgements(self) -> List[Email]:
+        return []
+
 
 @dataclass
 class ExchangeEmail(Email):
@@ -62,13 +125,15 @@ class ExchangeEmail(Email):
 
     def mark_as_read(self):
         self.original_message.is_read = True
-        self.original_message.save(update_fields=['is_read'])
+        with metrics.time('mark_as_read'):
+            self.original_message.save(update_fields=['is_read'])
 
     def forward(self, recipient, subject=None, body=''):
         if subject is None:
             subject = 'Fwd: {}'.format(self.subject)
 
-        self.original_message.forward(subject, body, [recipient])
+        with metrics.time('forward'):
+            self.original_message.forward(subject, body, [recipient])
 
 
 class EWSEmailService:
@@ -76,6 +141,9 @@ class EWSEmailService:
     alias: str
     exchange_client: Account
     folder: Messages
+    mark_as_read_batch_size: int
+    look_ahead: int
+    page_size: int
 
     def __init__(self,
                  email_address,
@@ -85,11 +153,37 @@ class EWSEmailService:
                  tenant_id=None,
                  folder=None,
                  alias=None,
+                 mark_as_read_batch_size=None,
+                 look_ahead=None,
+                 page_size=None,
                  *args,
                  **kwargs
                  ):
         self.email_address = email_address
         self.alias = alias
+        self.mark_as_read_batch_size = mark_as_read_batch_size
+        self.look_ahead = look_ahead
+        self.page_size = page_size
+        self._pending_acknowledgements = []
+        self._pending_acknowledgements_lock = Lock()
+        self._sync_state = None
+        self._unacknowledged_items = {}
+
+        self._cache_key = (email_address, folder,
+                           _get_credentials_fingerprint(password, client_id, client_secret, tenant_id))
+
+        cached_client = _exchange_clients.get(self._cache_key)
+        if cached_client is not None:
+            self.exchange_client, self.folder = cached_client
+            try:
+                # Updates the unread count of the folder, this is the only EWS call for an empty mailbox.
+                self.folder.refresh()
+            except Exception:
+                # E.g. expired credentials, a folder that was removed or a broken connection. The next invocation
+                # connects again instead of failing the same way.
+                self.invalidate_exchange_client()
+                raise
+            return
 
         self.initialize_exchange_client(password, client_id, client_secret, tenant_id)
 
@@ -98,8 +192,16 @@ class EWSEmailService:
         else:
             self.folder = self.exchange_client.inbox / folder
 
-    @retry(exceptions=(AutoDiscoverFailed, RateLimitError, ErrorServerBusy, ReadTimeoutError),
-           tries=10, delay=30, logger=None)
+        _exchange_clients[self._cache_key] = (self.exchange_client, self.folder)
+
+    def invalidate_exchange_client(self):
+        """
+        Removes the account and folder of this mailbox from the cache, so a new connection is made next time.
+        """
+        _exchange_clients.pop(self._cache_key, None)
+
+    # Throttling is handled by the rate limiter of the tenant, see RateLimitedRetryPolicy.
+    @retry(exceptions=(AutoDiscoverFailed, ReadTimeoutError), tries=3, delay=2, backoff=2, logger=None)
     def initialize_exchange_client(self, password=None, client_id=None, client_secret=None, tenant_id=None):
         if client_id is not None:
             acc_credentials = OAuth2Credentials(client_id, client_secret, tenant_id)
@@ -108,58 +210,319 @@ class EWSEmailService:
         credentials_type = OAUTH2 if client_id is not None else BASIC
 
         version = Version(build=Build(config.EXCHANGE_VERSION['major'], config.EXCHANGE_VERSION['minor']))
+        # Mailboxes of the same tenant share its throttling budget.
+        rate_limiter = get_rate_limiter(tenant_id or self.email_address.split('@')[-1].lower())
         acc_config = Configuration(service_endpoint=config.EXCHANGE_URL, credentials=acc_credentials,
                                    auth_type=credentials_type, version=version,
-                                   retry_policy=FaultTolerance(max_wait=300))
+                                   retry_policy=RateLimitedRetryPolicy(rate_limiter))
         self.exchange_client = Account(primary_smtp_address=self.email_address, config=acc_config,
                                        credentials=acc_credentials, access_type=IMPERSONATION)
 
-    def retrieve_unread_emails(self) -> List[Email]:
-        if self.folder:
-            if self.folder.unread_count > 0:
-                logging.info('Found {} unread e-mail(s)'.format(self.folder.unread_count))
-
-                inbox_query = self.folder.filter(is_read=False) \
-                    .order_by('-datetime_received').only('subject', 'sender', 'received_by', 'datetime_sent',
-                                                         'datetime_received', 'unique_body', 'attachments')
-                inbox_query.page_size = 2
-
-                unread_mails = []
-                for message in inbox_query.iterator():
-                    try:
-                        if self.alias is None:
-                            received_by = self.email_address
-                        else:
-                            received_by = self.alias
-
-                        attachments = [Attachment(attachment.fp,
-                                                  attachment.name,
-                                                  attachment.content_type,
-                                                  attachment.content_id,
-                                                  storage_bucket=None,
-                                                  storage_filename=None)
-                                       for attachment in message.attachments
-                                       # This line filters any attachments that do not have file attached to them
-                                       # Attachments can also be messages or exchange items.
-                                       # See https://github.com/ecederstrand/exchangelib/issues/335
-                                       if not attachment.is_inline and isinstance(attachment, FileAttachment)]
-
-                        email = ExchangeEmail(uuid=uuid4(),
-                                              subject=message.subject,
-                                              sender=str(message.sender.email_address),
-                                              receiver=received_by,
-                                              time_sent=message.datetime_sent,
-                                              time_received=message.datetime_received,
-                                              body=message.unique_body,
-                                              attachments=attachments,
-                                              original_message=message)
-                        unread_mails.append(email)
-                    except Exception:
-                        logging.error("Error retrieving email", exc_info=True)
-                return unread_mails
-            else:
-                logging.info('No unread e-mails in mailbox')
-        else:
+    def _has_unread_emails(self) -> bool:
+        if not self.folder:
             raise Exception('Can\'t find the inbox')
 
+        if self.folder.unread_count > 0:
+            logging.info('Found {} unread e-mail(s)'.format(self.folder.unread_count))
+            return True
+
+        logging.info('No unread e-mails in mailbox')
+        return False
+
+    def _convert_message(self, message: Message) -> ExchangeEmail:
+        if self.alias is None:
+            received_by = self.email_address
+        else:
+            received_by = self.alias
+
+        # The attachments field only contains the attachment headers. The content of an attachment is retrieved
+        # with a separate GetAttachment call once its file is opened, which only happens for stored attachments.
+        attachments = [Attachment(self._get_attachment_file(attachment),
+                                  attachment.name,
+                                  attachment.content_type,
+                                  attachment.content_id,
+                                  storage_bucket=None,
+                                  storage_filename=None,
+                                  size=attachment.size)
+                       for attachment in message.attachments
+                       # This line filters any attachments that do not have file attached to them
+                       # Attachments can also be messages or exchange items.
+                       # See https://github.com/ecederstrand/exchangelib/issues/335
+                       if not attachment.is_inline and isinstance(attachment, FileAttachment)]
+
+        return ExchangeEmail(uuid=self._get_email_uuid(message),
+                             subject=message.subject,
+                             sender=str(message.sender.email_address),
+                             receiver=received_by,
+                             time_sent=message.datetime_sent,
+                             time_received=message.datetime_received,
+                             body=message.unique_body,
+                             attachments=attachments,
+                             original_message=message)
+
+    def _get_email_uuid(self, message: Message):
+        """
+        :return: a uuid that is the same every time the message is retrieved, so retries use the same storage paths.
+        """
+        return uuid5(_EMAIL_UUID_NAMESPACE, '{}/{}'.format(self.email_address, message.message_id or message.id))
+
+    @staticmethod
+    def _get_attachment_file(attachment: FileAttachment):
+        if get_storable_content_type(attachment.name, attachment.content_type) is None:
+            return None
+
+        return attachment.fp
+
+    def _get_page_size(self) -> int:
+        if self.page_size:
+            return self.page_size
+
+        return max(1, min(self.folder.unread_count, MAX_ADAPTIVE_PAGE_SIZE))
+
+    def _fetch_messages(self, item_ids: List[tuple], page_size: int) -> Iterator[Any]:
+        """
+        :return: the messages with the given (id, changekey) pairs, fetched in pages, or an exception in place of
+            a message that no longer exists.
+        """
+        return metrics.time_iterator(
+            self.exchange_client.fetch(ids=item_ids, folder=self.folder, only_fields=MESSAGE_FIELDS,
+                                       chunk_size=page_size), 'fetch')
+
+    def _iterate_unread_emails(self) -> Iterator[ExchangeEmail]:
+        # The ids of all unread emails are listed before the first email is yielded. Paging the is_read=False query
+        # by offset while the yielded emails are marked as read would shift the later emails to earlier pages,
+        # which are then skipped.
+        id_query = self.folder.filter(is_read=False).order_by('-datetime_received').values_list('id', 'changekey')
+        id_query.page_size = UNREAD_ID_PAGE_SIZE
+        with metrics.time('fetch'):
+            item_ids = list(id_query.iterator())
+
+        for message in self._fetch_messages(item_ids, self._get_page_size()):
+            if isinstance(message, Exception) or message.is_read:
+                # The message has been deleted, moved or read since it was listed.
+                continue
+
+            try:
+                yield self._convert_message(message)
+            except Exception:
+                logging.error("Error retrieving email", exc_info=True)
+
+    def retrieve_unread_emails(self) -> List[Email]:
+        if self._has_unread_emails():
+            return list(self._iterate_unread_emails())
+
         return []
+
+    def stream_unread_emails(self, look_ahead: int = None) -> Iterator[Email]:
+        """
+        Yields unread emails while the next ones are fetched from EWS in a background thread.
+        At most look_ahead emails are fetched ahead of the email that is being processed.
+        """
+        if not self._has_unread_emails():
+            return
+
+        fetched_emails = Queue(maxsize=look_ahead or self.look_ahead or 1)
+        stopped = Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    fetched_emails.put(item, timeout=1)
+                    return
+                except Full:
+                    continue
+
+        def fetch():
+            try:
+                for email in self._iterate_unread_emails():
+                    put(email)
+                    if stopped.is_set():
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(_END_OF_STREAM)
+
+        Thread(target=fetch, name='ews-fetch', daemon=True).start()
+
+        try:
+            while True:
+                item = fetched_emails.get()
+                if item is _END_OF_STREAM:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    def acknowledge(self, email: ExchangeEmail) -> List[Email]:
+        """
+        Marks an email as read. When a mark_as_read_batch_size is configured the email is queued and marked
+        as read together with the rest of its batch in a single EWS call.
+
+        :return: the emails that could not be marked as read.
+        """
+        if not self.mark_as_read_batch_size:
+            email.mark_as_read()
+            logging.info('Marked email {} as read'.format(email.uuid))
+            self._forget_unacknowledged_items([email])
+            return []
+
+        with self._pending_acknowledgements_lock:
+            self._pending_acknowledgements.append(email)
+            if len(self._pending_acknowledgements) < self.mark_as_read_batch_size:
+                return []
+
+        return self.flush_acknowledgements()
+
+    def flush_acknowledgements(self) -> List[Email]:
+        """
+        Marks all queued emails as read using a single bulk update.
+
+        :return: the emails that could not be marked as read.
+        """
+        with self._pending_acknowledgements_lock:
+            emails, self._pending_acknowledgements = self._pending_acknowledgements, []
+        if not emails:
+            return []
+
+        for email in emails:
+            email.original_message.is_read = True
+
+        try:
+            with metrics.time('mark_as_read'):
+                results = self.exchange_client.bulk_update(
+                    items=[(email.original_message, ['is_read']) for email in emails],
+                    chunk_size=self.mark_as_read_batch_size)
+        except Exception:
+            logging.error('Error marking {} e-mail(s) as read'.format(len(emails)), exc_info=True)
+            return emails
+
+        failed_emails = []
+        marked_emails = []
+        for email, result in zip(emails, results):
+            if isinstance(result, Exception):
+                logging.error('Error marking email {} as read: {}'.format(email.uuid, result))
+                failed_emails.append(email)
+            else:
+                marked_emails.append(email)
+        self._forget_unacknowledged_items(marked_emails)
+
+        logging.info('Marked {} of {} e-mail(s) as read'.format(len(emails) - len(failed_emails), len(emails)))
+        return failed_emails
+
+    def _forget_unacknowledged_items(self, emails: List[ExchangeEmail]):
+        with self._pending_acknowledgements_lock:
+            for email in emails:
+                self._unacknowledged_items.pop(email.original_message.id, None)
+
+    def _sync_item_changes(self, sync_state):
+        """
+        Retrieves at most SYNC_MAX_CHANGES item changes after sync_state with a single SyncFolderItems call.
+        Folder.sync_items() can't be used for this, because it keeps calling SyncFolderItems until the folder
+        is fully synced.
+
+        :return: the (change type, item) pairs, with only the ids and is_read of the items, or an exception in place
+            of a change that could not be retrieved, and the new sync state.
+        """
+        service = SyncFolderItems(account=self.exchange_client)
+        additional_fields = {field_path for field_path in self.folder.normalize_fields(fields=['is_read'])
+                             if not field_path.field.is_attribute}
+        changes = list(service.call(folder=self.folder, shape=ID_ONLY, additional_fields=additional_fields,
+                                    sync_state=sync_state, ignore=None, max_changes_returned=SYNC_MAX_CHANGES,
+                                    sync_scope=None))
+        if not service.includes_last_item_in_range:
+            logging.info('Folder has more changes than SYNC_MAX_CHANGES, they are synced by the next run')
+
+        return changes, service.sync_state
+
+    def sync_new_emails(self, state_store, state_key: str) -> Iterator[Email]:
+        """
+        Yields the emails that were added to the folder since the sync state saved under state_key, followed by
+        the emails of earlier syncs that have not been acknowledged yet. Emails that have already been read are
+        skipped, so a run that stopped before save_sync_state() doesn't cause them to be published again.
+        The new sync state is only saved by save_sync_state().
+        """
+        state = state_store.load(state_key) or {}
+        sync_state = state.get('sync_state', None)
+
+        self._unacknowledged_items = {item_id: (item_id, changekey)
+                                      for item_id, changekey in state.get('unacknowledged_items', [])}
+
+        # Only the ids of the changes are retrieved, the messages themselves are fetched in pages below.
+        changes, self._sync_state = self._sync_item_changes(sync_state)
+        for change in changes:
+            if isinstance(change, Exception):
+                logging.error('Skipping folder change that could not be retrieved: {}'.format(change))
+                continue
+
+            change_type, item = change
+            if change_type != 'create' or item.is_read:
+                continue
+            self._unacknowledged_items[item.id] = (item.id, item.changekey)
+
+        logging.info('Found {} new e-mail(s) since the last sync'.format(len(self._unacknowledged_items)))
+        yield from self.fetch_emails(list(self._unacknowledged_items.values()))
+
+    def fetch_emails(self, item_ids: List[tuple]) -> Iterator[Email]:
+        """
+        Yields the emails with the given (id, changekey) pairs. They are kept as unacknowledged items, see
+        get_unacknowledged_items(), until they are acknowledged. Emails that no longer exist or that have been marked
+        as read since they were found, e.g. because they were also retrieved as unread emails, are skipped.
+        """
+        if not item_ids:
+            return
+
+        with self._pending_acknowledgements_lock:
+            for item_id, changekey in item_ids:
+                self._unacknowledged_items[item_id] = (item_id, changekey)
+
+        messages = self._fetch_messages(item_ids, self.page_size or MAX_ADAPTIVE_PAGE_SIZE)
+        for (item_id, _), message in zip(item_ids, messages):
+            if isinstance(message, Exception):
+                # The message has been deleted or moved since it was found.
+                logging.info('Skipping e-mail that no longer exists: {}'.format(message))
+                with self._pending_acknowledgements_lock:
+                    self._unacknowledged_items.pop(item_id, None)
+                continue
+
+            if message.is_read:
+                logging.info('Skipping e-mail that has already been read: {}'.format(item_id))
+                with self._pending_acknowledgements_lock:
+                    self._unacknowledged_items.pop(item_id, None)
+                continue
+
+            try:
+                yield self._convert_message(message)
+            except Exception:
+                logging.error("Error retrieving email", exc_info=True)
+
+    def get_unacknowledged_items(self) -> List[tuple]:
+        """
+        :return: the (id, changekey) pairs of the fetched emails that have not been acknowledged.
+        """
+        with self._pending_acknowledgements_lock:
+            return list(self._unacknowledged_items.values())
+
+    def count_deferred_emails(self) -> int:
+        """
+        :return: the number of emails that are left for a next run: the unacknowledged emails when syncing, otherwise
+            the unread emails in the folder.
+        """
+        if self._sync_state is not None:
+            return len(self.get_unacknowledged_items())
+
+        self.folder.refresh()
+        return self.folder.unread_count
+
+    def save_sync_state(self, state_store, state_key: str):
+        """
+        Saves the sync state of the last sync_new_emails() call, together with the emails that were not acknowledged.
+        """
+        if self._sync_state is None:
+            return
+
+        unacknowledged_items = self.get_unacknowledged_items()
+        state_store.save(state_key, {'sync_state': self._sync_state, 'unacknowledged_items': unacknowledged_items})
+        logging.info('Saved sync state with {} unacknowledged e-mail(s)'.format(len(unacknowledged_items)))
@@ -1,95 +1,571 @@
+# Imported first, so IMPORT_PROFILE also times the imports below.
+import import_profile  # isort: skip
+
+import json
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from typing import TYPE_CHECKING
 
 import requests
+from exchangelib.errors import UnauthorizedError
+from oauthlib.oauth2 import OAuth2Error
 from requests.exceptions import ConnectionError
 from retry import retry
 
+import config
 from config import (BUCKET_NAME, EMAIL_ADDRESSES, ERROR_EMAIL_ADDRESS,
                     ERROR_EMAIL_MESSAGE, PROJECT_ID, TOPIC_NAME)
+from idempotency import PUBLISHED, STORED, EmailProgress, get_idempotency_store
 from mail import EWSEmailService
-from publish import MailPublishService
-from storage.email_attachment_storage import EmailAttachmentStorageService
-from utils import get_secret
+from metrics import METRICS_FILE, OPENMETRICS_CONTENT_TYPE, metrics
+from publish import MailPublishService, get_publisher_client
+from ratelimit import get_rate_limiters
+from state_store import get_state_store
+from utils import get_secret, invalidate_secret
+
+if TYPE_CHECKING:
+    from storage.email_attachment_storage import EmailAttachmentStorageService
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 
+# Number of emails that are processed concurrently.
+# Emails are processed one by one when not set.
+PROCESSING_WORKERS = getattr(config, "PROCESSING_WORKERS", None)
+
+# Pub/Sub BatchSettings, e.g. {"max_messages": 100, "max_latency": 0.05}.
+# Every message is published and awaited one by one when not set.
+PUBSUB_BATCH_SETTINGS = getattr(config, "PUBSUB_BATCH_SETTINGS", None)
+
+# Groups of mailbox identifiers that are processed by a single invocation with ?group=<name>.
+MAILBOX_GROUPS = getattr(config, "MAILBOX_GROUPS", {})
+# Number of mailboxes of a group that are processed concurrently.
+MAILBOX_CONCURRENCY = getattr(config, "MAILBOX_CONCURRENCY", 1)
+# Number of seconds after which no new emails are taken from a mailbox of a group.
+MAILBOX_TIME_BUDGET = getattr(config, "MAILBOX_TIME_BUDGET", None)
+
+# Number of seconds after which the function times out. When set, no new emails are
+# taken once the time left can't cover one more, so the function can flush in time.
+FUNCTION_TIMEOUT = getattr(config, "FUNCTION_TIMEOUT", None)
+# Number of seconds before FUNCTION_TIMEOUT that are kept free for flushing.
+FUNCTION_TIMEOUT_MARGIN = getattr(config, "FUNCTION_TIMEOUT_MARGIN", 30)
+# Initial estimate of the number of seconds it takes to process an email.
+EMAIL_COST_ESTIMATE = getattr(config, "EMAIL_COST_ESTIMATE", 1)
+
+# Shared by all invocations of a warm function instance.
+_storage_service = None
+# Estimated cost of an email per mailbox identifier, kept across warm invocations.
+_email_cost_estimates = {}
+
+
+class EmailCostEstimate:
+    """
+    Exponentially weighted moving average of the seconds it takes to process an email.
+    """
+
+    def __init__(self, seconds, weight=0.2):
+        self.seconds = seconds
+        self.weight = weight
+
+    def update(self, seconds):
+        self.seconds += self.weight * (seconds - self.seconds)
+
+
+def report_unacknowledged_emails(failed_emails):
+    """
+    Reports the emails that acknowledging or flushing the acknowledgements could not
+    mark as read. They stay unread, so the next run processes them again.
+    """
+    for email in failed_emails:
+        metrics.increment("emails_unacknowledged")
+        logging.error(
+            "Email {} could not be marked as read and is processed again by the next "
+            "run".format(email.uuid)
+        )
+
 
 @retry(ConnectionError, tries=3, delay=2, logger=None, backoff=2)
 def publish_and_mark(
-    storage_service: EmailAttachmentStorageService,
+    storage_service: "EmailAttachmentStorageService",
     publish_service: MailPublishService,
+    email_service: EWSEmailService,
     email,
     identifier,
+    progress: EmailProgress = None,
 ):
+    """
+    Stores, publishes and marks the email, skipping the stages that the progress of the
+    email records as done, so a retry resumes from the stage that failed.
+    """
+    if progress is None:
+        progress = EmailProgress(email)
+
+    progress.attempts += 1
+    if progress.attempts > 1:
+        metrics.increment("retries", stage="publish_and_mark")
+
     if storage_service:
-        storage_service.store_attachments(email, identifier)
-    publish_service.publish_email(email)
-    email.mark_as_read()
-    logging.info("Marked email {} as read".format(email.uuid))
+        if progress.is_done(STORED):
+            progress.restore_stored_attachments()
+        else:
+            storage_service.store_attachments(email, identifier)
+            progress.complete_storing()
 
+    if progress.is_done(PUBLISHED):
+        report_unacknowledged_emails(email_service.acknowledge(email))
+        return
 
-def handler(request):
-    storage_service = None
-    if BUCKET_NAME:
-        storage_service = EmailAttachmentStorageService(BUCKET_NAME)
-    publish_service = MailPublishService(TOPIC_NAME, request)
+    def on_published(published_email):
+        progress.complete_publishing()
+        report_unacknowledged_emails(email_service.acknowledge(published_email))
 
-    identifier = request.args.get("identifier", None)
+    # The email is acknowledged once its message has been published. When publishing
+    # in batches, this happens when the publish service is flushed.
+    publish_service.publish_email(
+        email,
+        on_published=on_published,
+        storage_service=storage_service,
+        identifier=identifier,
+    )
 
-    if identifier is None:
-        raise ValueError("No email address specified.")
 
+def process_email(
+    storage_service: "EmailAttachmentStorageService",
+    publish_service: MailPublishService,
+    email_service: EWSEmailService,
+    email,
+    identifier,
+    mailbox,
+):
+    logging.info(
+        "Processing email {} from sender {}".format(email.subject, email.sender)
+    )
+    try:
+        with metrics.time("process_email"):
+            progress = get_idempotency_store().get_progress(email, identifier)
+            publish_and_mark(
+                storage_service,
+                publish_service,
+                email_service,
+                email,
+                identifier,
+                progress,
+            )
+        metrics.increment("emails", result="processed")
+    except Exception as e:
+        metrics.increment("emails", result="failed")
+        handle_failed_email(email_service, email, mailbox, e)
+
+
+def handle_failed_email(email_service: EWSEmailService, email, mailbox, exception):
+    if ERROR_EMAIL_ADDRESS:
+        logging.info(
+            "Error processing email '{}' in mailbox {}. Forwarding to {}".format(
+                email.subject,
+                mailbox,
+                ERROR_EMAIL_ADDRESS,
+            ),
+            exc_info=exception,
+        )
+
+        email.forward(ERROR_EMAIL_ADDRESS, None, ERROR_EMAIL_MESSAGE)
+        report_unacknowledged_emails(email_service.acknowledge(email))
+    else:
+        logging.error(
+            "Error processing email '{}' in mailbox {} because of {}".format(
+                email.subject, mailbox, exception
+            ),
+            exc_info=exception,
+        )
+
+
+def flush_published_emails(
+    publish_service: MailPublishService, email_service: EWSEmailService, mailbox
+):
+    for email, exception in publish_service.flush():
+        handle_failed_email(email_service, email, mailbox, exception)
+
+
+def process_emails_concurrently(
+    storage_service: "EmailAttachmentStorageService",
+    publish_service: MailPublishService,
+    email_service: EWSEmailService,
+    emails,
+    identifier,
+    mailbox,
+):
+    """
+    Processes emails on a pool of PROCESSING_WORKERS threads. No more emails are taken
+    from the (possibly streaming) iterable than there are workers to process them.
+    """
+    available_workers = BoundedSemaphore(PROCESSING_WORKERS)
+
+    def on_processed(future):
+        available_workers.release()
+        if future.exception() is not None:
+            logging.error(
+                "Error handling failed email in mailbox {}".format(mailbox),
+                exc_info=future.exception(),
+            )
+
+    with ThreadPoolExecutor(
+        max_workers=PROCESSING_WORKERS, thread_name_prefix="process-email"
+    ) as executor:
+        for email in emails:
+            available_workers.acquire()
+            future = executor.submit(
+                process_email,
+                storage_service,
+                publish_service,
+                email_service,
+                email,
+                identifier,
+                mailbox,
+            )
+            future.add_done_callback(on_processed)
+
+            if publish_service.should_flush():
+                flush_published_emails(publish_service, email_service, mailbox)
+
+
+def process_emails(
+    storage_service: "EmailAttachmentStorageService",
+    publish_service: MailPublishService,
+    email_service: EWSEmailService,
+    emails,
+    identifier,
+    mailbox,
+):
+    """
+    Stores, publishes and marks the emails, then flushes the pending messages and
+    acknowledgements. They are also flushed when retrieving the emails fails, so the
+    emails that were processed before are not processed again by the next run.
+    """
+    try:
+        if PROCESSING_WORKERS:
+            process_emails_concurrently(
+                storage_service,
+                publish_service,
+                email_service,
+                emails,
+                identifier,
+                mailbox,
+            )
+        else:
+            for email in emails:
+                process_email(
+                    storage_service,
+                    publish_service,
+                    email_service,
+                    email,
+                    identifier,
+                    mailbox,
+                )
+                if publish_service.should_flush():
+                    flush_published_emails(publish_service, email_service, mailbox)
+    finally:
+        try:
+            flush_published_emails(publish_service, email_service, mailbox)
+        finally:
+            report_unacknowledged_emails(email_service.flush_acknowledgements())
+
+
+def get_mailbox_secret(credentials, secret_key):
+    secret_id = credentials.get(secret_key, None)
+    if secret_id is None:
+        return None
+
+    return get_secret(PROJECT_ID, secret_id)
+
+
+def create_email_service(credentials):
+    def connect():
+        return EWSEmailService(
+            email_address=credentials["email"],
+            password=get_mailbox_secret(credentials, "secret_id"),
+            client_id=credentials.get("client_id", None),
+            client_secret=get_mailbox_secret(credentials, "client_secret_id"),
+            tenant_id=credentials.get("tenant_id", None),
+            folder=credentials.get("folder", None),
+            alias=credentials.get("alias", None),
+            mark_as_read_batch_size=credentials.get("mark_as_read_batch_size", None),
+            look_ahead=credentials.get("look_ahead", None),
+            page_size=credentials.get("page_size", None),
+        )
+
+    try:
+        return connect()
+    except (UnauthorizedError, OAuth2Error):
+        # The password or client secret may have been rotated since it was cached.
+        # Cached accounts are keyed by their credentials, so fresh secrets also get a new account.
+        logging.warning(
+            "Authentication failed for mailbox {}, retrying with fresh secrets".format(
+                credentials["email"]
+            )
+        )
+        for secret_key in ("secret_id", "client_secret_id"):
+            if credentials.get(secret_key, None) is not None:
+                invalidate_secret(PROJECT_ID, credentials[secret_key])
+        return connect()
+
+
+def take_until(emails, deadline, mailbox, cost_estimate: EmailCostEstimate = None):
+    """
+    Yields emails until the deadline (a time.monotonic() value) has passed or, given a
+    cost estimate, until the time left can't cover processing one more email. The cost
+    estimate is updated with the time between taking two emails.
+    """
+    taken_at = None
+
+    for email in emails:
+        now = time.monotonic()
+        if cost_estimate is not None and taken_at is not None:
+            cost_estimate.update(now - taken_at)
+
+        if now + (cost_estimate.seconds if cost_estimate else 0) >= deadline:
+            logging.info(
+                "Time budget of mailbox {} exceeded, deferring remaining emails".format(
+                    mailbox
+                )
+            )
+            # Stops fetching emails in the background when streaming.
+            if hasattr(emails, "close"):
+                emails.close()
+            return
+
+        taken_at = now
+        yield email
+
+
+def get_deadline(started_at, time_budget=None, deadline=None):
+    """
+    :return: the earliest of the deadline and the end of the time budget, or None.
+    """
+    if not time_budget:
+        return deadline
+    if deadline is None:
+        return started_at + time_budget
+    return min(started_at + time_budget, deadline)
+
+
+def process_mailbox(
+    identifier,
+    request,
+    storage_service: "EmailAttachmentStorageService",
+    publisher=None,
+    time_budget=None,
+    deadline=None,
+):
+    """
+    Processes the emails of a mailbox, taking no new emails once the time budget (in
+    seconds) is used or the deadline (a time.monotonic() value) is near.
+
+    :return: the number of emails deferred to a next run, or None if all were taken.
+    """
     credentials = EMAIL_ADDRESSES.get(identifier, None)
 
     if credentials is None:
         raise ValueError("No credentials found for given email address.")
 
+    started_at = time.monotonic()
+    publish_service = MailPublishService(
+        TOPIC_NAME, request, batch_settings=PUBSUB_BATCH_SETTINGS, publisher=publisher
+    )
+
     email_address = credentials["email"]
-    password = get_secret(PROJECT_ID, credentials["secret_id"])
-
-    client_id = credentials["client_id"]
-    client_secret = get_secret(PROJECT_ID, credentials["client_secret_id"])
-    tenant_id = credentials["tenant_id"]
-
-    email_service = EWSEmailService(
-        email_address=email_address,
-        password=password,
-        client_id=client_id,
-        client_secret=client_secret,
-        tenant_id=tenant_id,
-        folder=credentials.get("folder", None),
-        alias=credentials.get("alias", None),
+    email_service = create_email_service(credentials)
+
+    state_store = None
+    if credentials.get("incremental_sync", False):
+        state_store = get_state_store()
+        if state_store is None:
+            raise ValueError("Incremental sync requires STATE_BUCKET or STATE_DIRECTORY.")
+        emails = email_service.sync_new_emails(state_store, "sync/" + identifier)
+    elif email_service.look_ahead:
+        emails = email_service.stream_unread_emails()
+    else:
+        emails = email_service.retrieve_unread_emails()
+
+    mailbox = credentials.get("alias", email_address)
+
+    deadline = get_deadline(started_at, time_budget, deadline)
+    if deadline is not None:
+        cost_estimate = _email_cost_estimates.setdefault(
+            identifier, EmailCostEstimate(EMAIL_COST_ESTIMATE)
+        )
+        emails = take_until(emails, deadline, mailbox, cost_estimate)
+
+    process_emails(
+        storage_service, publish_service, email_service, emails, identifier, mailbox
     )
 
-    emails = email_service.retrieve_unread_emails()
+    if state_store is not None:
+        email_service.save_sync_state(state_store, "sync/" + identifier)
 
-    for email in emails:
+    if deadline is not None and time.monotonic() + cost_estimate.seconds >= deadline:
+        deferred = email_service.count_deferred_emails()
+        metrics.increment("emails_deferred", deferred)
         logging.info(
-            "Processing email {} from sender {}".format(email.subject, email.sender)
+            "Deferred {} email(s) of mailbox {} to the next run".format(
+                deferred, mailbox
+            )
         )
-        try:
-            publish_and_mark(storage_service, publish_service, email, identifier)
-        except Exception as e:
-            if ERROR_EMAIL_ADDRESS:
-                logging.info(
-                    "Error processing email '{}' in mailbox {}. Forwarding to {}".format(
-                        email.subject,
-                        credentials.get("alias", email_address),
-                        ERROR_EMAIL_ADDRESS,
-                    ),
-                    exc_info=True,
-                )
+        return deferred
+
+    return None
+
+
+def parse_shard(shard=None, shards=None):
+    """
+    :return: the shard and number of shards of a request as integers, or (None, None)
+        when the request isn't sharded.
+    :raises ValueError: if they are not integers with 0 <= shard < shards.
+    """
+    if shards is None:
+        if shard is not None:
+            raise ValueError("A shard requires the number of shards.")
+        return None, None
+
+    try:
+        shard, shards = int(shard or 0), int(shards)
+    except ValueError:
+        raise ValueError("The shard and number of shards must be integers.")
+
+    if not 0 <= shard < shards:
+        raise ValueError("The shard must be at least 0 and less than the number of shards.")
+
+    return shard, shards
+
+
+def get_group_identifiers(group, shard=None, shards=None):
+    """
+    :return: the mailbox identifiers of a group in MAILBOX_GROUPS. When shards is given,
+        only every shards-th identifier starting at shard is returned.
+    """
+    identifiers = MAILBOX_GROUPS.get(group, None)
+
+    if identifiers is None:
+        raise ValueError("No mailbox group found with name {}.".format(group))
+
+    if shards:
+        identifiers = identifiers[shard or 0::shards]
+
+    return identifiers
+
+
+def process_mailboxes(identifiers, request, storage_service, publisher, deadline=None):
+    """
+    Processes up to MAILBOX_CONCURRENCY mailboxes at the same time. An error in one
+    mailbox is logged and does not stop the other mailboxes from being processed.
+    Mailboxes that are not started before the deadline are deferred to a next run.
+    """
 
-                email.forward(ERROR_EMAIL_ADDRESS, None, ERROR_EMAIL_MESSAGE)
-                email.mark_as_read()
-            else:
-                logging.error(
-                    "Error processing email '{}' in mailbox {} because of {}".format(
-                        email.subject, credentials.get("alias", email_address), e
-                    ),
-                    exc_info=True,
+    def process_isolated_mailbox(identifier):
+        if deadline is not None and time.monotonic() >= deadline:
+            logging.info(
+                "No time left for mailbox {}, deferring it to the next run".format(
+                    identifier
                 )
+            )
+            return
+
+        try:
+            process_mailbox(
+                identifier,
+                request,
+                storage_service,
+                publisher=publisher,
+                time_budget=MAILBOX_TIME_BUDGET,
+                deadline=deadline,
+            )
+        except Exception:
+            logging.error(
+                "Error processing mailbox {}".format(identifier), exc_info=True
+            )
+
+    with ThreadPoolExecutor(
+        max_workers=MAILBOX_CONCURRENCY or 1, thread_name_prefix="process-mailbox"
+    ) as executor:
+        list(executor.map(process_isolated_mailbox, identifiers))
+
+
+def get_storage_service():
+    global _storage_service
+
+    if _storage_service is None and BUCKET_NAME:
+        # Imported on first use, functions without a bucket don't load the storage
+        # and cleaner modules.
+        from storage.email_attachment_storage import EmailAttachmentStorageService
+
+        _storage_service = EmailAttachmentStorageService(BUCKET_NAME)
+
+    return _storage_service
+
+
+def report_metrics(since):
+    """
+    Logs a structured summary of the metrics since the given snapshot, and writes all
+    metrics to METRICS_FILE when set.
+    """
+    for tenant, rate_limiter in get_rate_limiters().items():
+        metrics.set_gauge("ews_request_rate", rate_limiter.rate, tenant=tenant)
+
+    logging.info(
+        json.dumps(
+            {"message": "Invocation summary", "metrics": metrics.summarize(since)}
+        )
+    )
+
+    if METRICS_FILE:
+        metrics.write_openmetrics(METRICS_FILE)
+
+
+def handler(request):
+    if "metrics" in request.args:
+        return metrics.to_openmetrics(), 200, {"Content-Type": OPENMETRICS_CONTENT_TYPE}
+
+    started = metrics.snapshot()
+    try:
+        return process_request(request)
+    finally:
+        report_metrics(started)
+        import_profile.report_imports()
+
+
+def process_request(request):
+    deadline = None
+    if FUNCTION_TIMEOUT:
+        deadline = time.monotonic() + FUNCTION_TIMEOUT - FUNCTION_TIMEOUT_MARGIN
+
+    storage_service = get_storage_service()
+
+    identifier = request.args.get("identifier", None)
+    group = request.args.get("group", None)
+
+    if group is not None:
+        try:
+            shard, shards = parse_shard(
+                request.args.get("shard", None), request.args.get("shards", None)
+            )
+        except ValueError as e:
+            logging.warning("Invalid shard of group {}: {}".format(group, e))
+            return str(e), 400
+
+        process_mailboxes(
+            get_group_identifiers(group, shard, shards),
+            request,
+            storage_service,
+            publisher=get_publisher_client(PUBSUB_BATCH_SETTINGS),
+            deadline=deadline,
+        )
+        return
+
+    if identifier is None:
+        raise ValueError("No email address specified.")
+
+    process_mailbox(identifier, request, storage_service, deadline=deadline)
 
 
 if __name__ == "__main__":
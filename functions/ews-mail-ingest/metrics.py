@@ -0,0 +1,148 @@
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+import config
+
+# File the metrics are written to in the OpenMetrics text format after every invocation.
+METRICS_FILE = getattr(config, 'METRICS_FILE', None)
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _format_key(name: str, labels: tuple) -> str:
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(label, value) for label, value in labels))
+
+
+def _format_sample(name: str, labels: tuple, value) -> str:
+    if labels:
+        name = '{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in labels))
+    return '{} {}'.format(name, value)
+
+
+class Metrics:
+    """
+    Thread-safe timers per stage of the pipeline, counters and gauges of a function instance.
+
+    Timers and counters only increase, per-invocation values are the difference with a snapshot().
+    """
+
+    def __init__(self, prefix: str = 'ews_mail_ingest'):
+        self._prefix = prefix
+        self._timers = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, stage: str, seconds: float, **labels):
+        key = self._key(stage, labels)
+        with self._lock:
+            count, total = self._timers.get(key, (0, 0.0))
+            self._timers[key] = (count + 1, total + seconds)
+
+    @contextmanager
+    def time(self, stage: str, **labels):
+        """
+        Times the stage of the pipeline the with-block runs, also when it raises.
+        """
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - started_at, **labels)
+
+    def time_iterator(self, iterable, stage: str, **labels):
+        """
+        Yields the items of an iterable, timing the retrieval of every item as a stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.time(stage, **labels):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'timers': dict(self._timers), 'counters': dict(self._counters), 'gauges': dict(self._gauges)}
+
+    def summarize(self, since: dict = None) -> dict:
+        """
+        :return: a JSON serializable summary of the metrics since the given snapshot.
+        """
+        current = self.snapshot()
+        since = since or {'timers': {}, 'counters': {}}
+
+        stages = {}
+        for key, (count, total) in current['timers'].items():
+            since_count, since_total = since['timers'].get(key, (0, 0.0))
+            if count > since_count:
+                stages[_format_key(*key)] = {'count': count - since_count,
+                                             'seconds': round(total - since_total, 6)}
+
+        counters = {}
+        for key, value in current['counters'].items():
+            if value > since['counters'].get(key, 0):
+                counters[_format_key(*key)] = value - since['counters'].get(key, 0)
+
+        return {'stages': stages, 'counters': counters,
+                'gauges': {_format_key(*key): value for key, value in current['gauges'].items()}}
+
+    def to_openmetrics(self) -> str:
+        """
+        :return: the metrics in the OpenMetrics text format.
+        """
+        current = self.snapshot()
+        lines = []
+
+        stage_seconds = '{}_stage_seconds'.format(self._prefix)
+        if current['timers']:
+            lines.append('# TYPE {} summary'.format(stage_seconds))
+            lines.append('# UNIT {} seconds'.format(stage_seconds))
+        for (stage, labels), (count, total) in sorted(current['timers'].items()):
+            labels = (('stage', stage),) + labels
+            lines.append(_format_sample(stage_seconds + '_count', labels, count))
+            lines.append(_format_sample(stage_seconds + '_sum', labels, total))
+
+        for metric_type, metrics, suffix in (('counter', current['counters'], '_total'),
+                                             ('gauge', current['gauges'], '')):
+            for name in sorted({name for name, _ in metrics}):
+                metric_name = '{}_{}'.format(self._prefix, name)
+                lines.append('# TYPE {} {}'.format(metric_name, metric_type))
+                for (_, labels), value in sorted(item for item in metrics.items() if item[0][0] == name):
+                    lines.append(_format_sample(metric_name + suffix, labels, value))
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_openmetrics(self, path: str):
+        """
+        Atomically replaces the file at path with the metrics in the OpenMetrics text format.
+        """
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.to_openmetrics())
+        os.replace(path + '.tmp', path)
+
+
+# Shared by all invocations of a warm function instance.
+metrics = Metrics()
@@ -0,0 +1,128 @@
+import logging
+import multiprocessing
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+
+
+def _work(connection):
+    """
+    Runs the tasks that are received on connection in a worker process, until None is received.
+    """
+    while True:
+        task = connection.recv()
+        if task is None:
+            return
+
+        fn, args = task
+        try:
+            result = (True, fn(*args))
+        except Exception as e:
+            result = (False, e)
+
+        try:
+            connection.send(result)
+        except Exception as e:
+            # The result or exception can't be pickled.
+            connection.send((False, RuntimeError('Unable to return the result of {}: {}'.format(fn.__name__, e))))
+
+
+class _Worker:
+    def __init__(self, context):
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=_work, args=(worker_connection,), daemon=True)
+        self.process.start()
+        worker_connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+class LazyProcessPool:
+    """
+    A pool of worker processes that are only started when tasks are submitted. A task that exceeds its timeout is
+    stopped by terminating the worker process that runs it, so tasks in the other workers are not affected.
+    """
+
+    def __init__(self, max_workers: int, name: str):
+        self._name = name
+        # Worker processes are forked from a clean server process, because forking the function itself
+        # is not safe while gRPC and other threads are running.
+        self._context = multiprocessing.get_context('forkserver')
+        self._available_workers = BoundedSemaphore(max_workers)
+        self._idle_workers = []
+        self._workers = set()
+        self._lock = Lock()
+
+    def _get_worker(self) -> _Worker:
+        with self._lock:
+            if self._idle_workers:
+                return self._idle_workers.pop()
+
+        worker = _Worker(self._context)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _discard_worker(self, worker: _Worker):
+        with self._lock:
+            self._workers.discard(worker)
+        worker.kill()
+
+    def run(self, fn, *args, timeout: float = None):
+        """
+        Runs fn(*args) in a worker process and returns its result. Waits for a worker when all are busy.
+
+        :raises TimeoutError: if the result is not available within timeout seconds.
+        :raises BrokenProcessPool: if the worker process died, e.g. because it ran out of memory.
+        """
+        with self._available_workers:
+            worker = self._get_worker()
+            try:
+                worker.connection.send((fn, args))
+                finished = worker.connection.poll(timeout)
+                if finished:
+                    succeeded, result = worker.connection.recv()
+            except (EOFError, OSError) as e:
+                # The worker is replaced for the next task.
+                self._discard_worker(worker)
+                raise BrokenProcessPool('A {} worker process terminated abruptly'.format(self._name)) from e
+
+            if not finished:
+                logging.warning('Terminating {} worker process after a task exceeded {} seconds'.format(
+                    self._name, timeout))
+                self._discard_worker(worker)
+                raise TimeoutError()
+
+            with self._lock:
+                returned = worker in self._workers
+                if returned:
+                    self._idle_workers.append(worker)
+            if not returned:
+                # The pool was terminated while the task was running.
+                worker.stop()
+
+        if not succeeded:
+            raise result
+        return result
+
+    def terminate(self):
+        """
+        Stops all worker processes, including those that are running a task.
+        """
+        with self._lock:
+            workers, self._workers, self._idle_workers = self._workers, set(), []
+
+        for worker in workers:
+            worker.stop()
@@ -1,69 +1,174 @@
 import json
 import logging
+from threading import Lock
 
 from gobits import Gobits
-from google.cloud.pubsub_v1 import PublisherClient
 from requests import Request
 
-from bleach import Cleaner, sanitizer
-from config import ALLOWED_HTML_BODY_TAGS, ATTACHMENTS_TO_STORE
+import config
+from config import ATTACHMENTS_TO_STORE
 from mail import Attachment, Email
+from metrics import metrics
+
+try:
+    # Optional, serializes messages faster than json into the same JSON.
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# google-cloud-pubsub and bleach are imported on first use, so an invocation without emails to publish doesn't
+# load them.
+
+# Bodies of more than this number of (UTF-8 encoded) bytes are stored in the bucket instead of being
+# published, the message then refers to the stored body with "body_reference". Bodies are always published
+# when not set.
+BODY_OFFLOAD_SIZE = getattr(config, "BODY_OFFLOAD_SIZE", None)
+# Compression of stored bodies, None or "gzip".
+BODY_OFFLOAD_COMPRESSION = getattr(config, "BODY_OFFLOAD_COMPRESSION", None)
+
+
+def serialize_message(message: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(message)
+
+    return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+
+def get_batch_settings(batch_settings: dict):
+    from google.cloud.pubsub_v1.types import BatchSettings
+
+    return BatchSettings(**batch_settings)
+
+
+def get_publisher_client(batch_settings: dict = None):
+    from google.cloud.pubsub_v1 import PublisherClient
+
+    if batch_settings is not None:
+        return PublisherClient(batch_settings=get_batch_settings(batch_settings))
+
+    return PublisherClient()
 
 
 class PublishService:
-    _publisher: PublisherClient
     _topic_name: str
     _request: Request
+    _batch_settings: dict
 
-    def __init__(self, topic_name: str, request: Request):
-        self._publisher = PublisherClient()
+    def __init__(self, topic_name: str, request: Request, batch_settings: dict = None, publisher=None):
+        """
+        :param batch_settings: when given, messages are published in batches using these BatchSettings.
+            The publish results are only awaited when flush() is called.
+        :param publisher: a client to share with other publish services, created with the same batch_settings.
+            A client is created when the first message is published when not given.
+        """
+        self._batch_settings = batch_settings
+        self._max_messages = None
+        self._publisher = publisher
+        self._publisher_lock = Lock()
         self._topic_name = topic_name
         self._request = request
 
-    def _publish_message(self, message_name, message):
+        self._pending = []
+        self._pending_lock = Lock()
+
+    def _get_publisher(self):
+        with self._publisher_lock:
+            if self._publisher is None:
+                self._publisher = get_publisher_client(self._batch_settings)
+            return self._publisher
+
+    def _publish_message(self, message_name, message, reference=None, on_published=None):
         metadata = Gobits.from_request(request=self._request)
         try:
             my_gobits = [metadata.to_json()]
         except:  # noqa: E722
             my_gobits = []
         message_to_publish = {"gobits": my_gobits, message_name: message}
-        future = self._publisher.publish(
-            self._topic_name, bytes(json.dumps(message_to_publish).encode("utf-8"))
-        )
-        logging.info(f"Published email with ID {message['subject']}: {future.result()}")
+        with metrics.time("publish"):
+            future = self._get_publisher().publish(
+                self._topic_name, serialize_message(message_to_publish)
+            )
+
+            if self._batch_settings is not None:
+                with self._pending_lock:
+                    self._pending.append((future, message, reference, on_published))
+                return
+
+            message_id = future.result()
+
+        logging.info(f"Published email with ID {message['subject']}: {message_id}")
+        if on_published is not None:
+            on_published()
+
+    def should_flush(self) -> bool:
+        """
+        :return: whether a full batch of messages is waiting to be flushed.
+        """
+        if self._batch_settings is None or not self._pending:
+            return False
+
+        if self._max_messages is None:
+            self._max_messages = get_batch_settings(self._batch_settings).max_messages
+        return len(self._pending) >= self._max_messages
+
+    def flush(self) -> list:
+        """
+        Waits for all pending messages to be published and calls their on_published callbacks.
+
+        :return: a list of (reference, exception) tuples for the messages that failed to publish
+            or whose on_published callback failed.
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+
+        failed = []
+        for future, message, reference, on_published in pending:
+            try:
+                with metrics.time("publish_flush"):
+                    message_id = future.result()
+                logging.info(f"Published email with ID {message['subject']}: {message_id}")
+                if on_published is not None:
+                    on_published()
+            except Exception as e:
+                failed.append((reference, e))
+
+        return failed
 
 
 class MailPublishService(PublishService):
-    def _convert_email_to_message(self, email: Email):
-        allowed_html_body_tags = sanitizer.ALLOWED_TAGS + ALLOWED_HTML_BODY_TAGS
-
-        if ATTACHMENTS_TO_STORE:
-            return {
-                "sent_on": email.time_sent.isoformat(),
-                "received_on": email.time_received.isoformat(),
-                "subject": self.parse_html_content(email.subject, tags=[]),
-                "sender": email.sender,
-                "recipient": email.receiver,
-                "body": self.parse_html_content(
-                    email.body, tags=allowed_html_body_tags
-                ),
-                "attachments": [
-                    self._convert_attachment_to_message(attachment)
-                    for attachment in email.attachments
-                    if attachment.content_type in ATTACHMENTS_TO_STORE
-                ],
-            }
+    def _convert_email_to_message(self, email: Email, storage_service=None, identifier=None):
+        from sanitize import BODY_TAGS, SUBJECT_TAGS, sanitize_html
 
-        return {
+        message = {
             "sent_on": email.time_sent.isoformat(),
             "received_on": email.time_received.isoformat(),
-            "subject": self.parse_html_content(email.subject, tags=[]),
+            "subject": sanitize_html(email.subject, SUBJECT_TAGS),
             "sender": email.sender,
             "recipient": email.receiver,
-            "body": self.parse_html_content(email.body, tags=allowed_html_body_tags),
-            "attachments": [],
+            "body": sanitize_html(email.body, BODY_TAGS),
+            "attachments": [
+                self._convert_attachment_to_message(attachment)
+                for attachment in email.attachments
+                if attachment.content_type in ATTACHMENTS_TO_STORE
+            ]
+            if ATTACHMENTS_TO_STORE
+            else [],
         }
 
+        if (
+            storage_service is not None
+            and BODY_OFFLOAD_SIZE is not None
+            and message["body"] is not None
+            and len(message["body"].encode("utf-8")) > BODY_OFFLOAD_SIZE
+        ):
+            message["body_reference"] = storage_service.store_body(
+                email, message["body"], identifier, BODY_OFFLOAD_COMPRESSION
+            )
+            message["body"] = None
+            metrics.increment("bodies_offloaded")
+
+        return message
+
     def _convert_attachment_to_message(self, attachment: Attachment):
         return {
             "mimetype": attachment.content_type,
@@ -72,15 +177,25 @@ class MailPublishService(PublishService):
             "full_path": attachment.storage_filename,
         }
 
-    def publish_email(self, email: Email):
-        message = self._convert_email_to_message(email)
+    def publish_email(
+        self, email: Email, on_published=None, storage_service=None, identifier=None
+    ):
+        """
+        :param on_published: called with the email once its message has been published.
+        :param storage_service: stores the body when it is larger than BODY_OFFLOAD_SIZE.
+        """
+        message = self._convert_email_to_message(email, storage_service, identifier)
+
+        self._publish_message("email", message, reference=email,
+                              on_published=(lambda: on_published(email)) if on_published else None)
 
-        self._publish_message("email", message)
+        if self._batch_settings is not None:
+            # Published once flush() has awaited the message.
+            logging.info("Queued message for email {}".format(email.uuid))
+        else:
+            logging.info("Published message for email {}".format(email.uuid))
 
-        logging.info("Published message for email {}".format(email.uuid))
+    def parse_html_content(self, html, tags=()):
+        from sanitize import sanitize_html
 
-    def parse_html_content(self, html, **kwargs):
-        if html is None:
-            return None
-        cleaner = Cleaner(**kwargs, strip=True)
-        return cleaner.clean(html)
+        return sanitize_html(html, frozenset(tags))
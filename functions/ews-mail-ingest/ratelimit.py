@@ -0,0 +1,162 @@
+import logging
+import time
+from threading import Lock
+
+from exchangelib import FaultTolerance
+
+import config
+from metrics import metrics
+
+# Maximum number of EWS requests per second that are sent to a single tenant. The rate is halved
+# (EWS_RATE_DECREASE) whenever the server throttles, and grows again by EWS_RATE_INCREASE requests
+# per second for every second without throttling.
+EWS_MAX_REQUEST_RATE = getattr(config, 'EWS_MAX_REQUEST_RATE', 10)
+EWS_MIN_REQUEST_RATE = getattr(config, 'EWS_MIN_REQUEST_RATE', 0.5)
+EWS_RATE_INCREASE = getattr(config, 'EWS_RATE_INCREASE', 0.5)
+EWS_RATE_DECREASE = getattr(config, 'EWS_RATE_DECREASE', 0.5)
+# Maximum number of seconds an EWS request waits for the rate limiter or a server back-off hint.
+EWS_MAX_WAIT = getattr(config, 'EWS_MAX_WAIT', 60)
+
+
+class ThrottledError(Exception):
+    """
+    Raised when an EWS request would have to wait longer than the maximum wait to be sent.
+    """
+    pass
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket whose rate is adapted to the throttling of the server: it decreases multiplicatively
+    when the server asks to back off and increases additively while it doesn't (AIMD).
+    """
+
+    def __init__(self, name: str, max_rate: float, min_rate: float, increase: float, decrease: float,
+                 max_wait: float):
+        self.name = name
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._increase = increase
+        self._decrease = decrease
+        self._max_wait = max_wait
+        self._rate = max_rate
+        self._tokens = max(1.0, max_rate)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    @property
+    def rate(self) -> float:
+        """
+        The current number of requests per second.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._rate
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+
+        # No tokens are gained while the server asked to back off.
+        if elapsed <= 0 or now < self._paused_until:
+            return
+
+        self._rate = min(self._max_rate, self._rate + self._increase * elapsed)
+        self._tokens = min(max(1.0, self._rate), self._tokens + self._rate * elapsed)
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+
+        :raises ThrottledError: if the request would have to wait longer than the maximum wait.
+        """
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait = max(self._paused_until - now, (1 - self._tokens) / self._rate)
+                if wait <= 0:
+                    self._tokens -= 1
+                    if waited:
+                        metrics.increment('throttle_wait_seconds', waited, tenant=self.name)
+                    return
+
+                if waited + wait > self._max_wait:
+                    raise ThrottledError('EWS requests to {} are throttled for another {:.1f} seconds'.format(
+                        self.name, wait))
+
+            time.sleep(wait)
+            waited += wait
+
+    def back_off(self, seconds: float = None):
+        """
+        Decreases the rate and, when the server gave a back-off hint, pauses all requests for that many seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            self._rate = max(self._min_rate, self._rate * self._decrease)
+            self._tokens = min(self._tokens, max(1.0, self._rate))
+            if seconds:
+                self._paused_until = max(self._paused_until, now + seconds)
+            metrics.increment('throttled', tenant=self.name)
+
+            logging.warning('EWS requests to {} are throttled, reducing rate to {:.2f} requests/s{}'.format(
+                self.name, self._rate, ' and pausing for {} seconds'.format(seconds) if seconds else ''))
+
+
+class RateLimitedRetryPolicy(FaultTolerance):
+    """
+    Retry policy that passes every EWS request of an account through a rate limiter.
+
+    exchangelib reads back_off_until before each request and calls back_off() with the hint of the server when it
+    is throttled, so the limiter also gates the requests exchangelib sends itself, e.g. when saving or forwarding.
+    """
+
+    def __init__(self, rate_limiter: AdaptiveRateLimiter, max_wait: float = EWS_MAX_WAIT):
+        super().__init__(max_wait=max_wait)
+        self.rate_limiter = rate_limiter
+
+    @property
+    def back_off_until(self):
+        self.rate_limiter.acquire()
+        # Waiting for the back-off hint is done by the rate limiter.
+        return None
+
+    @back_off_until.setter
+    def back_off_until(self, value):
+        pass
+
+    def back_off(self, seconds):
+        self.rate_limiter.back_off(seconds)
+
+
+# Shared by all mailboxes of a tenant in a (warm) function instance.
+_rate_limiters = {}
+_rate_limiters_lock = Lock()
+
+
+def get_rate_limiter(tenant: str) -> AdaptiveRateLimiter:
+    """
+    :return: the rate limiter of an Exchange tenant.
+    """
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(tenant)
+        if rate_limiter is None:
+            rate_limiter = AdaptiveRateLimiter(tenant, EWS_MAX_REQUEST_RATE, EWS_MIN_REQUEST_RATE, EWS_RATE_INCREASE,
+                                               EWS_RATE_DECREASE, EWS_MAX_WAIT)
+            _rate_limiters[tenant] = rate_limiter
+        return rate_limiter
+
+
+def get_rate_limiters() -> dict:
+    """
+    :return: the rate limiters by tenant, e.g. to report their current rates.
+    """
+    with _rate_limiters_lock:
+        return dict(_rate_limiters)
@@ -0,0 +1,56 @@
+import logging
+import re
+import threading
+
+from bleach import Cleaner, sanitizer
+
+import config
+from process_pool import LazyProcessPool
+
+SUBJECT_TAGS = frozenset()
+BODY_TAGS = frozenset(sanitizer.ALLOWED_TAGS) | frozenset(config.ALLOWED_HTML_BODY_TAGS)
+
+# HTML larger than this number of characters is sanitized in a separate process.
+HTML_SANITIZE_OFFLOAD_SIZE = getattr(config, 'HTML_SANITIZE_OFFLOAD_SIZE', None)
+HTML_SANITIZE_WORKERS = getattr(config, 'HTML_SANITIZE_WORKERS', 1)
+
+# Text without these characters is returned unchanged by a Cleaner: markup characters
+# are escaped or stripped, and control characters are normalized.
+_CHANGED_BY_CLEANER = re.compile('[<>&\x00-\x08\x0b-\x1f\x7f-\x9f]')
+
+# Cleaners keep parser state while cleaning, so every thread gets its own cleaner per tag set.
+_cleaners = threading.local()
+
+_html_process_pool = LazyProcessPool(HTML_SANITIZE_WORKERS, 'HTML sanitizing') if HTML_SANITIZE_OFFLOAD_SIZE else None
+
+
+def get_cleaner(tags: frozenset) -> Cleaner:
+    cleaners = getattr(_cleaners, 'by_tags', None)
+    if cleaners is None:
+        cleaners = _cleaners.by_tags = {}
+
+    cleaner = cleaners.get(tags)
+    if cleaner is None:
+        cleaner = cleaners[tags] = Cleaner(tags=list(tags), strip=True)
+    return cleaner
+
+
+def _clean(html: str, tags: frozenset) -> str:
+    return get_cleaner(tags).clean(html)
+
+
+def sanitize_html(html, tags: frozenset):
+    """
+    Strips all tags that are not in tags from html.
+    """
+    if html is None:
+        return None
+
+    if not _CHANGED_BY_CLEANER.search(html):
+        return html
+
+    if _html_process_pool is not None and len(html) > HTML_SANITIZE_OFFLOAD_SIZE:
+        logging.debug('Sanitizing {} characters of HTML in a separate process'.format(len(html)))
+        return _html_process_pool.run(_clean, html, tags)
+
+    return _clean(html, tags)
@@ -0,0 +1,104 @@
+import json
+import os
+from threading import Lock
+
+import config
+
+# Where small pieces of state (e.g. sync checkpoints) are kept between invocations: a GCS bucket,
+# or a local directory for testing.
+STATE_BUCKET = getattr(config, 'STATE_BUCKET', None)
+STATE_PREFIX = getattr(config, 'STATE_PREFIX', 'ews-mail-ingest-state/')
+STATE_DIRECTORY = getattr(config, 'STATE_DIRECTORY', None)
+
+
+class StateStore:
+    def load(self, key: str):
+        """
+        :return: the JSON value stored under key, or None if there is none.
+        """
+        pass
+
+    def save(self, key: str, value):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+
+class GCSStateStore(StateStore):
+    def __init__(self, bucket_name: str, prefix: str = '', client=None):
+        # Imported here, so google-cloud-storage is only loaded when STATE_BUCKET is used.
+        from google.cloud import storage
+
+        self._bucket = (client or storage.Client()).bucket(bucket_name)
+        self._prefix = prefix
+
+    def _blob(self, key: str):
+        return self._bucket.blob(self._prefix + key + '.json')
+
+    def load(self, key: str):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return json.loads(self._blob(key).download_as_bytes())
+        except NotFound:
+            return None
+
+    def save(self, key: str, value):
+        self._blob(key).upload_from_string(json.dumps(value), content_type='application/json')
+
+    def delete(self, key: str):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self._blob(key).delete()
+        except NotFound:
+            pass
+
+
+class LocalStateStore(StateStore):
+    def __init__(self, directory: str):
+        self._directory = directory
+        self._lock = Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key + '.json')
+
+    def load(self, key: str):
+        try:
+            with open(self._path(key), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key: str, value):
+        path = self._path(key)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(value, f)
+            os.replace(path + '.tmp', path)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+_state_store = None
+
+
+def get_state_store() -> StateStore:
+    """
+    :return: the state store configured by STATE_BUCKET or STATE_DIRECTORY, or None if neither is set.
+    """
+    global _state_store
+
+    if _state_store is None:
+        if STATE_BUCKET:
+            _state_store = GCSStateStore(STATE_BUCKET, STATE_PREFIX)
+        elif STATE_DIRECTORY:
+            _state_store = LocalStateStore(STATE_DIRECTORY)
+
+    return _state_store
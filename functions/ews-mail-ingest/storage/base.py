@@ -1,14 +1,45 @@
+import http.client
+import io
 import logging
+from threading import Lock
 from uuid import uuid4
 
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
 from google.resumable_media import requests, common
 
+import config
+from metrics import metrics
+from state_store import get_state_store
 from storage.cleaners import FileCleaner
+from storage.deduplication import ATTACHMENT_DEDUPLICATION, AttachmentIndex, hash_file
+from storage.memory import ATTACHMENT_SPOOL_MAX_BYTES
+
+# Size of the chunks of a resumable upload, must be a multiple of 256 KiB.
+# Files smaller than a chunk are uploaded with a single request.
+UPLOAD_CHUNK_SIZE = getattr(config, 'UPLOAD_CHUNK_SIZE', 1024 * 1024)
+# Number of bytes read from an attachment at a time while uploading it.
+UPLOAD_READ_SIZE = getattr(config, 'UPLOAD_READ_SIZE', 64 * 1024)
+
+
+class ObjectExistsError(Exception):
+    pass
+
+
+def _raise_if_object_exists(error: common.InvalidResponse):
+    if error.response.status_code == http.client.PRECONDITION_FAILED:
+        raise ObjectExistsError('Object already exists') from error
 
 
 class GCSObjectStreamUpload(object):
+    """
+    Uploads a stream of data to a GCS object. The data is uploaded with a single request if it is smaller
+    than the chunk size, and in chunks using a resumable upload otherwise.
+
+    The object is only created if it does not exist yet, otherwise an ObjectExistsError is raised.
+    """
+
     def __init__(
             self,
             client: storage.Client,
@@ -22,8 +53,7 @@ class GCSObjectStreamUpload(object):
         self._blob = self._bucket.blob(blob_name)
         self._content_type = content_type
 
-        self._buffer = b''
-        self._buffer_size = 0
+        self._buffer = bytearray()
         self._chunk_size = chunk_size
         self._read = 0
 
@@ -33,7 +63,6 @@ class GCSObjectStreamUpload(object):
         self._request = None  # type: requests.ResumableUpload
 
     def __enter__(self):
-        self.start()
         return self
 
     def __exit__(self, exc_type, *_):
@@ -43,41 +72,70 @@ class GCSObjectStreamUpload(object):
     def start(self):
         url = (
             f'https://www.googleapis.com/upload/storage/v1/b/'
-            f'{self._bucket.name}/o?uploadType=resumable'
+            f'{self._bucket.name}/o?uploadType=resumable&ifGenerationMatch=0'
         )
         self._request = requests.ResumableUpload(
             upload_url=url, chunk_size=self._chunk_size
         )
-        self._request.initiate(
-            transport=self._transport,
-            content_type=self._content_type,
-            stream=self,
-            stream_final=False,
-            metadata={'name': self._blob.name},
-        )
+        try:
+            self._request.initiate(
+                transport=self._transport,
+                content_type=self._content_type,
+                stream=self,
+                stream_final=False,
+                metadata={'name': self._blob.name},
+            )
+        except common.InvalidResponse as e:
+            _raise_if_object_exists(e)
+            raise
 
     def stop(self):
-        self._request.transmit_next_chunk(self._transport)
+        if self._request is None:
+            # All data fits in a single chunk, so there is no need for a resumable upload session.
+            url = (
+                f'https://www.googleapis.com/upload/storage/v1/b/'
+                f'{self._bucket.name}/o?uploadType=multipart&ifGenerationMatch=0'
+            )
+            try:
+                requests.MultipartUpload(upload_url=url).transmit(
+                    transport=self._transport,
+                    data=self.read(len(self._buffer)),
+                    metadata={'name': self._blob.name},
+                    content_type=self._content_type,
+                )
+            except common.InvalidResponse as e:
+                _raise_if_object_exists(e)
+                raise
+            return
+
+        try:
+            self._request.transmit_next_chunk(self._transport)
+        except common.InvalidResponse as e:
+            _raise_if_object_exists(e)
+            raise
 
     def write(self, data: bytes) -> int:
         data_len = len(data)
-        self._buffer_size += data_len
-        self._buffer += data
+        self._buffer.extend(data)
         del data
-        while self._buffer_size >= self._chunk_size:
+        while len(self._buffer) >= self._chunk_size:
+            if self._request is None:
+                self.start()
             try:
                 self._request.transmit_next_chunk(self._transport)
-            except common.InvalidResponse:
+            except common.InvalidResponse as e:
+                _raise_if_object_exists(e)
                 self._request.recover(self._transport)
         return data_len
 
     def read(self, chunk_size: int) -> bytes:
-        to_read = min(chunk_size, self._buffer_size)
-        memview = memoryview(self._buffer)
-        self._buffer = memview[to_read:].tobytes()
+        to_read = min(chunk_size, len(self._buffer))
+        with memoryview(self._buffer) as memview:
+            data = memview[:to_read].tobytes()
+        # Deleting from the start of a bytearray does not copy the remaining data.
+        del self._buffer[:to_read]
         self._read += to_read
-        self._buffer_size -= to_read
-        return memview[:to_read].tobytes()
+        return data
 
     def tell(self) -> int:
         return self._read
@@ -87,27 +145,122 @@ class StorageService:
     bucket_name: str
     credentials = None
 
-    def __init__(self, bucket_name: str):
+    def __init__(self, bucket_name: str, deduplication: str = ATTACHMENT_DEDUPLICATION,
+                 attachment_index: AttachmentIndex = None):
+        if deduplication not in (None, 'reference', 'copy'):
+            raise ValueError('Unknown attachment deduplication mode {}.'.format(deduplication))
+
         self.bucket_name = bucket_name
-        self.storage_client = storage.Client()
+        self.deduplication = deduplication
+        self._storage_client = None
+        self._storage_client_lock = Lock()
 
-    def _store_file(self, file, filename: str, content_type: str = None):
-        file = FileCleaner(file, filename, content_type).clean()
+        if deduplication and attachment_index is None:
+            attachment_index = AttachmentIndex(get_state_store())
+        self.attachment_index = attachment_index
 
-        bucket = self.storage_client.bucket(self.bucket_name)
-        if storage.Blob(bucket=bucket, name=filename).exists(self.storage_client):
-            filename_components = filename.split('.')
-            filename_components.insert(len(filename_components) - 1, str(uuid4()))
-            filename = '.'.join(filename_components)
-
-        with GCSObjectStreamUpload(client=self.storage_client,
-                                   bucket_name=self.bucket_name,
-                                   blob_name=filename,
-                                   content_type=content_type) as f, file as fp:
-            buffer = fp.read(1024)
+    @property
+    def storage_client(self) -> storage.Client:
+        """
+        The GCS client, which is only created when the first file is stored.
+        """
+        with self._storage_client_lock:
+            if self._storage_client is None:
+                self._storage_client = storage.Client()
+            return self._storage_client
+
+    def _upload_file(self, fp, filename: str, content_type: str = None):
+        upload = GCSObjectStreamUpload(client=self.storage_client,
+                                       bucket_name=self.bucket_name,
+                                       blob_name=filename,
+                                       content_type=content_type,
+                                       chunk_size=UPLOAD_CHUNK_SIZE)
+        uploaded_bytes = 0
+        with metrics.time('upload'), upload as f:
+            buffer = fp.read(UPLOAD_READ_SIZE)
             while buffer:
                 f.write(buffer)
-                buffer = fp.read(1024)
+                uploaded_bytes += len(buffer)
+                buffer = fp.read(UPLOAD_READ_SIZE)
+
+        metrics.increment('bytes_uploaded', uploaded_bytes)
+
+    def _store_file(self, file, filename: str, content_type: str = None):
+        if not self.deduplication:
+            return self._clean_and_store_file(file, filename, content_type)
+
+        with file as fp:
+            content_hash, raw_file = hash_file(fp, UPLOAD_READ_SIZE, ATTACHMENT_SPOOL_MAX_BYTES)
+
+        duplicate_filename = self._store_duplicate(content_hash, content_type, filename)
+        if duplicate_filename is not None:
+            raw_file.close()
+            return duplicate_filename
+
+        filename = self._clean_and_store_file(raw_file, filename, content_type)
+        self.attachment_index.put(content_hash, content_type, filename)
+
+        return filename
+
+    def _store_duplicate(self, content_hash: str, content_type: str, filename: str):
+        """
+        Stores a file whose content was stored before without cleaning and uploading it again, either by referencing
+        or by copying the earlier object.
+
+        :return: the name of the object the file is stored as, or None if the content was not stored before.
+        """
+        existing_filename = self.attachment_index.get(content_hash, content_type)
+        if existing_filename is None:
+            return None
+
+        bucket = self.storage_client.bucket(self.bucket_name)
+        try:
+            if self.deduplication == 'reference':
+                if not bucket.blob(existing_filename).exists():
+                    raise NotFound('Object {} no longer exists'.format(existing_filename))
+                stored_filename = existing_filename
+            else:
+                stored_filename = filename
+                try:
+                    bucket.copy_blob(bucket.blob(existing_filename), bucket, stored_filename, if_generation_match=0)
+                except PreconditionFailed:
+                    stored_filename = self._get_unique_filename(filename)
+                    bucket.copy_blob(bucket.blob(existing_filename), bucket, stored_filename, if_generation_match=0)
+        except NotFound:
+            logging.info('Object {} no longer exists, storing file {} again'.format(existing_filename, filename))
+            self.attachment_index.forget(content_hash, content_type)
+            return None
+
+        logging.info('File {} is a duplicate of {}, stored as {}'.format(filename, existing_filename, stored_filename))
+        metrics.increment('attachments_deduplicated', content_type=content_type)
+
+        return stored_filename
+
+    @staticmethod
+    def _get_unique_filename(filename: str) -> str:
+        filename_components = filename.split('.')
+        filename_components.insert(len(filename_components) - 1, str(uuid4()))
+        return '.'.join(filename_components)
+
+    def _clean_and_store_file(self, file, filename: str, content_type: str = None):
+        with metrics.time('clean', content_type=content_type):
+            file = FileCleaner(file, filename, content_type).clean()
+        metrics.increment('attachments_cleaned', content_type=content_type)
+
+        with file as fp:
+            try:
+                self._upload_file(fp, filename, content_type)
+            except ObjectExistsError:
+                filename = self._get_unique_filename(filename)
+
+                try:
+                    fp.seek(0)
+                except io.UnsupportedOperation:
+                    # Attachments that are streamed from EWS can't be rewound, so they are retrieved again.
+                    with file as retry_fp:
+                        self._upload_file(retry_fp, filename, content_type)
+                else:
+                    self._upload_file(fp, filename, content_type)
 
         logging.info(
             "File uploaded to bucket {} with filename {}.".format(
@@ -1,15 +1,51 @@
 import io
 import logging
+import os
 import tempfile
-import warnings
+from concurrent.futures import TimeoutError
+# ElementTree is triggered as a security risk by bandit, but it is only used to write trees parsed by defusedxml
+from xml.etree.ElementTree import ElementTree  # nosec
 
-from PyPDF2.utils import PdfReadWarning
-from defusedxml import ElementTree as defusedxml_ET
-# Etree is triggered as a security risk by bandit, but we use defusedxml to sanitize before reading into etree
-from lxml import etree as ET  # nosec
-from pikepdf import Pdf
+import config
+from process_pool import LazyProcessPool
+from storage.memory import ATTACHMENT_SPOOL_MAX_BYTES, spool_file
 
-warnings.simplefilter('ignore', PdfReadWarning)
+# Number of processes PDF files are cleaned in. PDF files are cleaned in the calling thread when not set.
+PDF_CLEAN_WORKERS = getattr(config, 'PDF_CLEAN_WORKERS', None)
+# Maximum size in bytes and maximum cleaning time in seconds (process pool only) of a PDF file.
+PDF_CLEAN_MAX_BYTES = getattr(config, 'PDF_CLEAN_MAX_BYTES', None)
+PDF_CLEAN_TIMEOUT = getattr(config, 'PDF_CLEAN_TIMEOUT', None)
+# What to do with PDF files that exceed these limits: 'reject' raises a FileCleaningError,
+# 'store' stores the file without cleaning it.
+PDF_CLEAN_FALLBACK = getattr(config, 'PDF_CLEAN_FALLBACK', 'reject')
+
+# Cleaned XML files larger than this number of bytes are written to a temporary file instead of memory.
+XML_SPOOL_MAX_BYTES = getattr(config, 'XML_SPOOL_MAX_BYTES', 1024 * 1024)
+
+_pdf_process_pool = LazyProcessPool(PDF_CLEAN_WORKERS, 'PDF cleaning') if PDF_CLEAN_WORKERS else None
+
+
+class FileCleaningError(Exception):
+    pass
+
+
+def flatten_pdf_file(source, destination):
+    """
+    Flattens a PDF file, given as a path or a seekable file object, to a path or file object.
+    """
+    # pikepdf and defusedxml are only imported once a file of their type is cleaned, to keep them out of the
+    # cold start of the function.
+    from pikepdf import Pdf
+
+    with Pdf.open(source) as pdf:
+        pdf.flatten_annotations()  # Cleaning PDF (removing URI's, burning in filled in forms, etc.)
+        pdf.save(destination)  # Saving PDF object to the output stream.
+
+
+def flatten_pdf(data: bytes) -> bytes:
+    output_stream = io.BytesIO()
+    flatten_pdf_file(io.BytesIO(data), output_stream)
+    return output_stream.getvalue()
 
 
 class FileCleaner:
@@ -32,38 +68,71 @@ class FileCleaner:
     def _clean_pdf(self):
         # The file object needs to be buffered according to standards:
         # https://ecederstrand.github.io/exchangelib/#attachments
-        input_stream = io.BytesIO()
+        # Files larger than ATTACHMENT_SPOOL_MAX_BYTES are buffered in a temporary file instead of memory.
         with self.file as input_file:
-            buffer = input_file.read(1024)
-            while buffer:
-                input_stream.write(buffer)
-                buffer = input_file.read(1024)
-            input_stream.flush()  # Flush all data from BytesIO buffer to stream.
-            input_stream.seek(0)  # Setting stream to start from beginning (for later reading).
-
-        output_stream = io.BytesIO()
-        with input_stream as ips, Pdf.open(ips) as pdf:
-            pdf.flatten_annotations()  # Cleaning PDF (removing URI's, burning in filled in forms, etc.)
-            pdf.save(output_stream)  # Saving PDF object to the output stream.
-            output_stream.flush()
-            output_stream.seek(0)
-
-        return output_stream
+            # Files that exceed PDF_CLEAN_MAX_BYTES are only read in full when they are stored without cleaning.
+            spooled_file, size = spool_file(input_file, ATTACHMENT_SPOOL_MAX_BYTES,
+                                            limit=PDF_CLEAN_MAX_BYTES if PDF_CLEAN_FALLBACK != 'store' else None)
+
+        if PDF_CLEAN_MAX_BYTES and size > PDF_CLEAN_MAX_BYTES:
+            return self._clean_pdf_fallback('exceeds {} bytes'.format(PDF_CLEAN_MAX_BYTES), spooled_file)
+
+        try:
+            cleaned_file = self._flatten_pdf(spooled_file)
+        except TimeoutError:
+            return self._clean_pdf_fallback('took longer than {} seconds'.format(PDF_CLEAN_TIMEOUT), spooled_file)
+        except Exception:
+            spooled_file.close()
+            raise
+
+        spooled_file.close()
+        return cleaned_file
+
+    @staticmethod
+    def _flatten_pdf(spooled_file):
+        if _pdf_process_pool is None:
+            cleaned_file = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_MAX_BYTES, mode='w+b')
+            flatten_pdf_file(spooled_file, cleaned_file)
+            cleaned_file.seek(0)
+            return cleaned_file
+
+        if isinstance(spooled_file, io.BytesIO):
+            return io.BytesIO(_pdf_process_pool.run(flatten_pdf, spooled_file.getvalue(), timeout=PDF_CLEAN_TIMEOUT))
+
+        # Large files are passed to the cleaning process by path, instead of copying them through a pipe.
+        spooled_file.flush()
+        output_fd, output_path = tempfile.mkstemp(prefix='cleaned-', suffix='.pdf')
+        os.close(output_fd)
+        try:
+            _pdf_process_pool.run(flatten_pdf_file, spooled_file.name, output_path, timeout=PDF_CLEAN_TIMEOUT)
+            return open(output_path, 'rb')
+        finally:
+            # The opened file remains readable until it is closed.
+            os.remove(output_path)
+
+    def _clean_pdf_fallback(self, reason: str, spooled_file):
+        if PDF_CLEAN_FALLBACK == 'store':
+            logging.warning('Storing PDF file {} without cleaning it, because it {}'.format(self.file_name, reason))
+            spooled_file.seek(0)
+            return spooled_file
+
+        spooled_file.close()
+        raise FileCleaningError('Can\'t clean PDF file {}, because it {}'.format(self.file_name, reason))
 
     def _clean_xml(self):
-        with self.file as f:
-            xml_string = f.read()
-        safe_xml_tree = defusedxml_ET.fromstring(xml_string)
-        # Etree is triggered as a security risk by bandit, but we use defusedxml to sanitize before reading into etree
-        safe_xml_tree = ET.fromstring(defusedxml_ET.tostring(safe_xml_tree))  # nosec
+        # The XML file is parsed once and incrementally with defusedxml. Namespaces are stripped from
+        # each element as soon as it has been parsed.
+        from defusedxml import ElementTree as defusedxml_ET
 
-        for elem in safe_xml_tree.getiterator():
-            elem.tag = ET.QName(elem).localname
-
-        safe_xml_tree = ET.ElementTree(safe_xml_tree)
-
-        with tempfile.NamedTemporaryFile(mode='w+b', delete=False) as cleaned_xml_file:
-            safe_xml_tree.write(cleaned_xml_file, encoding="utf-8", method="xml", xml_declaration=True)
+        with self.file as f:
+            events = defusedxml_ET.iterparse(f, events=('end',))
+            for _, elem in events:
+                elem.tag = elem.tag.rpartition('}')[2]
+            safe_xml_tree = ElementTree(events.root)
+
+        cleaned_xml_file = tempfile.SpooledTemporaryFile(max_size=XML_SPOOL_MAX_BYTES, mode='w+b')
+        safe_xml_tree.write(cleaned_xml_file, encoding="utf-8", method="xml", xml_declaration=True)
+        cleaned_xml_file.seek(0)
 
         return cleaned_xml_file
 
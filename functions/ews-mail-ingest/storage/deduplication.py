@@ -0,0 +1,96 @@
+import hashlib
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+
+import config
+from state_store import StateStore
+
+# Deduplication of attachments by their content: 'reference' publishes a reference to the object of an earlier
+# copy of the attachment, 'copy' copies that object server-side to the path of the new attachment.
+# Attachments are always cleaned and uploaded when not set.
+ATTACHMENT_DEDUPLICATION = getattr(config, 'ATTACHMENT_DEDUPLICATION', None)
+# Number of stored attachments a function instance remembers, in addition to the ones in the state store.
+ATTACHMENT_INDEX_CACHE_SIZE = getattr(config, 'ATTACHMENT_INDEX_CACHE_SIZE', 1024)
+
+
+def hash_file(fp, read_size: int, spool_max_bytes: int):
+    """
+    Reads a file while hashing its content.
+
+    :return: the sha256 hex digest of the content and a copy of the file, spooled to disk above spool_max_bytes.
+    """
+    content_hash = hashlib.sha256()
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes, mode='w+b')
+
+    buffer = fp.read(read_size)
+    while buffer:
+        content_hash.update(buffer)
+        spooled_file.write(buffer)
+        buffer = fp.read(read_size)
+
+    spooled_file.seek(0)
+    return content_hash.hexdigest(), spooled_file
+
+
+class AttachmentIndex:
+    """
+    Index of the objects attachments were stored as by the hash of their raw content and their content-type.
+    """
+
+    def __init__(self, state_store: StateStore = None, cache_size: int = ATTACHMENT_INDEX_CACHE_SIZE):
+        self._state_store = state_store
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(content_hash: str, content_type: str) -> str:
+        return 'attachments/{}/{}'.format(content_type, content_hash)
+
+    def _remember(self, key: str, filename: str):
+        with self._lock:
+            self._cache[key] = filename
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def get(self, content_hash: str, content_type: str):
+        """
+        :return: the name of the object an attachment with the same content was stored as, or None.
+        """
+        key = self._key(content_hash, content_type)
+
+        with self._lock:
+            filename = self._cache.get(key)
+            if filename is not None:
+                self._cache.move_to_end(key)
+                return filename
+
+        if self._state_store is None:
+            return None
+
+        entry = self._state_store.load(key)
+        if entry is None:
+            return None
+
+        self._remember(key, entry['filename'])
+        return entry['filename']
+
+    def put(self, content_hash: str, content_type: str, filename: str):
+        key = self._key(content_hash, content_type)
+
+        self._remember(key, filename)
+        if self._state_store is not None:
+            self._state_store.save(key, {'filename': filename})
+
+    def forget(self, content_hash: str, content_type: str):
+        """
+        Removes an entry whose object no longer exists.
+        """
+        key = self._key(content_hash, content_type)
+
+        with self._lock:
+            self._cache.pop(key, None)
+        if self._state_store is not None:
+            self._state_store.delete(key)
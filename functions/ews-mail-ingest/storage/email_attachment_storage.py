@@ -1,9 +1,16 @@
+import gzip
+import hashlib
+import io
 import logging
-import mimetypes
+from concurrent.futures import ThreadPoolExecutor
 
-from config import ATTACHMENTS_TO_STORE
-from mail import Email, Attachment
-from storage.base import StorageService
+import config
+from mail import Email, Attachment, get_storable_content_type
+from storage.base import ObjectExistsError, StorageService
+from storage.memory import reserve_attachment_memory
+
+# Number of attachments of a single email that are uploaded concurrently.
+ATTACHMENT_UPLOAD_WORKERS = getattr(config, 'ATTACHMENT_UPLOAD_WORKERS', None)
 
 
 class EmailAttachmentStorageService(StorageService):
@@ -15,37 +22,94 @@ class EmailAttachmentStorageService(StorageService):
                                                                              uuid=email.uuid,
                                                                              file_name=attachment.name)
 
+    def get_body_file_name(self, email: Email, identifier: str, compression: str = None):
+        # Stored next to the directory of the attachments, so it can't collide with an attachment's name.
+        return '{identifier}/{year}/{month}/{day}/{uuid}.body.html{extension}'.format(
+            identifier=identifier, year=email.time_received.year, month=email.time_received.month,
+            day=email.time_received.day, uuid=email.uuid, extension='.gz' if compression == 'gzip' else '')
+
+    def store_body(self, email: Email, body: str, identifier: str, compression: str = None) -> dict:
+        """
+        Stores the (sanitized) HTML body of an email, optionally gzip compressed.
+
+        :return: a reference to the stored body, with the size and sha256 hash of the UTF-8 encoded body.
+        """
+        if compression not in (None, 'gzip'):
+            raise ValueError('Unknown body compression {}.'.format(compression))
+
+        data = body.encode('utf-8')
+        filename = self.get_body_file_name(email, identifier, compression)
+        reference = {
+            'bucket': self.bucket_name,
+            'full_path': filename,
+            'mimetype': 'text/html',
+            'size': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'compression': compression
+        }
+
+        if compression == 'gzip':
+            data = gzip.compress(data, compresslevel=6)
+
+        try:
+            self._upload_file(io.BytesIO(data), filename, 'application/gzip' if compression else 'text/html')
+        except ObjectExistsError:
+            # The path is derived from the email, so the body was stored by an earlier attempt.
+            logging.info('Body of email {} is already stored'.format(email.uuid))
+
+        return reference
+
+    def _store_attachment(self, email: Email, attachment: Attachment, identifier: str):
+        if attachment.storage_filename is not None:
+            logging.info('File {} for email {} is already stored'.format(attachment.name, email.uuid))
+            return
+
+        logging.info('Storing file {} for email {}'.format(attachment.name, email.uuid))
+
+        # Waits while other attachments use up the ATTACHMENT_MEMORY_BUDGET.
+        with reserve_attachment_memory(attachment.size):
+            attachment.storage_filename = self._store_file(file=attachment.file,
+                                                           filename=self.get_file_name(email, attachment, identifier),
+                                                           content_type=attachment.content_type)
+        attachment.storage_bucket = self.bucket_name
+
     def store_attachments(self, email: Email, identifier: str):
         """
+        Stores the attachments of an email, using up to ATTACHMENT_UPLOAD_WORKERS concurrent uploads.
+
         :param email:
         :param identifier:
         :return: the number of actual attachments stored.
         """
-        number_of_attachments = 0
+        attachments_to_store = []
         for attachment in email.attachments:
-            if attachment.content_type not in ATTACHMENTS_TO_STORE:
-                # Sometimes the mimetype of a file is application/octet-stream,
-                # while the file itself is actually a different type.
-                if attachment.content_type == 'application/octet-stream' \
-                        and mimetypes.guess_type(attachment.name)[0] in ATTACHMENTS_TO_STORE:
-                    logging.info('Converted attachment {} for email {}. Original content-type {} to {}'.format(
-                        attachment.name, email.uuid, attachment.content_type, mimetypes.guess_type(attachment.name)[0])
-                    )
-                    attachment.content_type = mimetypes.guess_type(attachment.name)[0]
-
-                else:
-                    # If the content-type and guessed mimetype are not allowed, we skip downloading this attachment.
-                    logging.info('Skipped attachment {} for email {}. content-type {} unknown'.format(
-                        attachment.name, email.uuid, attachment.content_type
-                    ))
-                    continue
-            logging.info('Storing file {} for email {}'.format(attachment.name, email.uuid))
+            content_type = get_storable_content_type(attachment.name, attachment.content_type)
+            if content_type is None:
+                # If the content-type and guessed mimetype are not allowed, we skip downloading this attachment.
+                logging.info('Skipped attachment {} for email {}. content-type {} unknown'.format(
+                    attachment.name, email.uuid, attachment.content_type
+                ))
+                continue
 
-            attachment.storage_filename = self._store_file(file=attachment.file,
-                                                           filename=self.get_file_name(email, attachment, identifier),
-                                                           content_type=attachment.content_type)
-            attachment.storage_bucket = self.bucket_name
-            number_of_attachments = number_of_attachments + 1
+            if content_type != attachment.content_type:
+                logging.info('Converted attachment {} for email {}. Original content-type {} to {}'.format(
+                    attachment.name, email.uuid, attachment.content_type, content_type)
+                )
+                attachment.content_type = content_type
+
+            attachments_to_store.append(attachment)
+
+        if ATTACHMENT_UPLOAD_WORKERS and len(attachments_to_store) > 1:
+            with ThreadPoolExecutor(max_workers=min(ATTACHMENT_UPLOAD_WORKERS, len(attachments_to_store)),
+                                    thread_name_prefix='store-attachment') as executor:
+                # Consuming the results raises the first error that occurred, after all uploads have finished.
+                list(executor.map(lambda attachment: self._store_attachment(email, attachment, identifier),
+                                  attachments_to_store))
+        else:
+            for attachment in attachments_to_store:
+                self._store_attachment(email, attachment, identifier)
+
+        number_of_attachments = len(attachments_to_store)
         logging.info('Stored {} attachments for email {}'.format(number_of_attachments, email.uuid))
 
         return number_of_attachments
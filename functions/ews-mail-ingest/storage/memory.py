@@ -0,0 +1,114 @@
+import io
+import tempfile
+import time
+from contextlib import contextmanager
+from threading import Condition
+
+import config
+from metrics import metrics
+
+# Attachments larger than this number of bytes are spooled to a temporary file instead of memory while they are
+# cleaned, and are passed to the PDF cleaning processes by path.
+ATTACHMENT_SPOOL_MAX_BYTES = getattr(config, 'ATTACHMENT_SPOOL_MAX_BYTES', 1024 * 1024)
+# Maximum number of attachment bytes that are stored concurrently by a function instance, across all emails.
+# Attachments wait until their size fits in the budget, an attachment larger than the budget takes all of it.
+# Unlimited when not set.
+ATTACHMENT_MEMORY_BUDGET = getattr(config, 'ATTACHMENT_MEMORY_BUDGET', None)
+
+# Number of bytes read from an attachment at a time while spooling it.
+SPOOL_READ_SIZE = 64 * 1024
+
+
+def spool_file(fp, max_memory_bytes: int, limit: int = None, read_size: int = SPOOL_READ_SIZE):
+    """
+    Copies a stream, e.g. an attachment that is retrieved from EWS, to memory or, once it exceeds max_memory_bytes,
+    to a named temporary file that other processes can open.
+
+    :param limit: when given, reading stops as soon as more than limit bytes were read.
+    :return: the copy, positioned at its start, and the number of bytes read.
+    """
+    spooled_file = io.BytesIO()
+    size = 0
+
+    while limit is None or size <= limit:
+        buffer = fp.read(read_size if limit is None else min(read_size, limit + 1 - size))
+        if not buffer:
+            break
+
+        if isinstance(spooled_file, io.BytesIO) and size + len(buffer) > max_memory_bytes:
+            named_file = tempfile.NamedTemporaryFile(prefix='attachment-')
+            named_file.write(spooled_file.getvalue())
+            spooled_file.close()
+            spooled_file = named_file
+
+        spooled_file.write(buffer)
+        size += len(buffer)
+
+    spooled_file.seek(0)
+    return spooled_file, size
+
+
+class ByteSemaphore:
+    """
+    Semaphore that limits a number of bytes instead of a number of holders. Bytes are acquired in the order they
+    were requested, so large acquisitions are not starved by smaller ones.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._available = capacity
+        self._next_ticket = 0
+        self._serving = 0
+        self._condition = Condition()
+
+    def acquire(self, size: int) -> int:
+        """
+        Blocks until size bytes are available. A size larger than the capacity acquires the whole capacity.
+
+        :return: the number of bytes acquired, which are to be released.
+        """
+        size = max(0, min(size, self.capacity))
+
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+
+            def can_acquire():
+                return self._serving == ticket and self._available >= size
+
+            if not can_acquire():
+                started_at = time.monotonic()
+                self._condition.wait_for(can_acquire)
+                metrics.increment('attachment_memory_wait_seconds', time.monotonic() - started_at)
+
+            self._available -= size
+            self._serving += 1
+            # The next ticket may fit in the bytes that are left.
+            self._condition.notify_all()
+
+        return size
+
+    def release(self, size: int):
+        with self._condition:
+            self._available += size
+            self._condition.notify_all()
+
+
+_attachment_memory_budget = ByteSemaphore(ATTACHMENT_MEMORY_BUDGET) if ATTACHMENT_MEMORY_BUDGET else None
+
+
+@contextmanager
+def reserve_attachment_memory(size: int = None):
+    """
+    Holds the with-block until size bytes of the ATTACHMENT_MEMORY_BUDGET are available, and releases them
+    afterwards. Attachments of unknown size reserve ATTACHMENT_SPOOL_MAX_BYTES.
+    """
+    if _attachment_memory_budget is None:
+        yield
+        return
+
+    acquired = _attachment_memory_budget.acquire(ATTACHMENT_SPOOL_MAX_BYTES if size is None else size)
+    try:
+        yield
+    finally:
+        _attachment_memory_budget.release(acquired)
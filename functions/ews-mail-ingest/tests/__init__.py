@@ -1 +1,16 @@
-from .test_email_service import TestMailModule  # noqa: F401
+from .test_email_service import TestMailModule, TestEWSEmailService  # noqa: F401
+from .test_main import TestHandler  # noqa: F401
+from .test_publish import TestMailPublishService  # noqa: F401
+from .test_storage import TestEmailAttachmentStorageService, TestAttachmentDeduplication, \
+    TestGCSObjectStreamUpload  # noqa: F401
+from .test_cleaners import TestFileCleaner, TestLazyProcessPool  # noqa: F401
+from .test_sanitize import TestSanitize  # noqa: F401
+from .test_utils import TestSecretCache  # noqa: F401
+from .test_state_store import TestLocalStateStore  # noqa: F401
+from .test_worker import TestMailboxWorker  # noqa: F401
+from .test_ratelimit import TestAdaptiveRateLimiter  # noqa: F401
+from .test_idempotency import TestIdempotencyStore  # noqa: F401
+from .test_metrics import TestMetrics  # noqa: F401
+from .test_benchmarks import TestBenchmark  # noqa: F401
+from .test_import_profile import TestImportProfile  # noqa: F401
+from .test_memory import TestAttachmentMemory  # noqa: F401
@@ -13,5 +13,8 @@ BUCKET_NAME = None
 TOPIC_NAME = None
 
 ERROR_EMAIL_ADDRESS = None
+ERROR_EMAIL_MESSAGE = None
 
 ATTACHMENTS_TO_STORE = ['application/pdf']
+
+ALLOWED_HTML_BODY_TAGS = []
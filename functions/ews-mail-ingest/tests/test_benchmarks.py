@@ -0,0 +1,23 @@
+import unittest
+
+from benchmarks.run import run_benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_processes_generated_mailbox(self):
+        result = run_benchmark(emails=3, pdf_size=8 * 1024, xml_attachments=1, xml_size=1024,
+                               mailbox_options={'mark_as_read_batch_size': 2})
+
+        self.assertEqual(result['emails_published'], 3)
+        self.assertEqual(result['emails_read'], 3)
+        self.assertEqual(result['objects_uploaded'], 6)
+        self.assertEqual(result['stages']['process_email']['count'], 3)
+        self.assertGreater(result['peak_rss']['self_kib'], 0)
+
+    def test_deduplicates_repeated_attachments(self):
+        result = run_benchmark(emails=4, pdf_size=8 * 1024, distinct_attachments=1,
+                               attachment_deduplication='reference')
+
+        self.assertEqual(result['emails_published'], 4)
+        self.assertEqual(result['objects_uploaded'], 1)
+        self.assertEqual(result['counters']['attachments_deduplicated{content_type=application/pdf}'], 3)
@@ -0,0 +1,109 @@
+import io
+import threading
+import time
+import unittest
+from concurrent.futures import TimeoutError
+from unittest.mock import patch
+
+from defusedxml import EntitiesForbidden
+from pikepdf import Pdf
+
+from process_pool import LazyProcessPool
+from storage import cleaners
+from storage.cleaners import FileCleaner, FileCleaningError
+
+
+def create_pdf() -> bytes:
+    output_stream = io.BytesIO()
+    with Pdf.new() as pdf:
+        pdf.add_blank_page()
+        pdf.save(output_stream)
+    return output_stream.getvalue()
+
+
+class TestFileCleaner(unittest.TestCase):
+    def test_clean_pdf(self):
+        cleaned_file = FileCleaner(io.BytesIO(create_pdf()), 'file.pdf', 'application/pdf').clean()
+
+        with Pdf.open(cleaned_file) as pdf:
+            self.assertEqual(len(pdf.pages), 1)
+
+    def test_clean_pdf_rejects_large_file(self):
+        with patch.object(cleaners, 'PDF_CLEAN_MAX_BYTES', 10):
+            with self.assertRaises(FileCleaningError):
+                FileCleaner(io.BytesIO(create_pdf()), 'file.pdf', 'application/pdf').clean()
+
+    def test_clean_pdf_stores_large_file(self):
+        data = create_pdf()
+
+        with patch.object(cleaners, 'PDF_CLEAN_MAX_BYTES', 10), patch.object(cleaners, 'PDF_CLEAN_FALLBACK', 'store'):
+            cleaned_file = FileCleaner(io.BytesIO(data), 'file.pdf', 'application/pdf').clean()
+
+        self.assertEqual(cleaned_file.read(), data)
+
+    def test_clean_pdf_in_process_pool(self):
+        process_pool = LazyProcessPool(1, 'test')
+        self.addCleanup(process_pool.terminate)
+
+        with patch.object(cleaners, '_pdf_process_pool', process_pool):
+            cleaned_file = FileCleaner(io.BytesIO(create_pdf()), 'file.pdf', 'application/pdf').clean()
+
+        with Pdf.open(cleaned_file) as pdf:
+            self.assertEqual(len(pdf.pages), 1)
+
+    def test_clean_large_pdf_spooled_to_disk(self):
+        process_pool = LazyProcessPool(1, 'test')
+        self.addCleanup(process_pool.terminate)
+
+        for pool in (None, process_pool):
+            with patch.object(cleaners, 'ATTACHMENT_SPOOL_MAX_BYTES', 10), \
+                    patch.object(cleaners, '_pdf_process_pool', pool):
+                cleaned_file = FileCleaner(io.BytesIO(create_pdf()), 'file.pdf', 'application/pdf').clean()
+
+            with cleaned_file, Pdf.open(cleaned_file) as pdf:
+                self.assertEqual(len(pdf.pages), 1)
+
+    def test_clean_xml(self):
+        xml = b'<?xml version="1.0"?><ns:invoice xmlns:ns="urn:invoice"><ns:line amount="1"/><total/></ns:invoice>'
+
+        with FileCleaner(io.BytesIO(xml), 'file.xml', 'application/xml').clean() as cleaned_file:
+            cleaned_xml = cleaned_file.read()
+
+        self.assertEqual(cleaned_xml, b"<?xml version='1.0' encoding='utf-8'?>\n"
+                                      b'<invoice><line amount="1" /><total /></invoice>')
+
+    def test_clean_xml_rejects_entities(self):
+        xml = b'<!DOCTYPE invoice [<!ENTITY x "entity">]><invoice>&x;</invoice>'
+
+        with self.assertRaises(EntitiesForbidden):
+            FileCleaner(io.BytesIO(xml), 'file.xml', 'text/xml').clean()
+
+
+class TestLazyProcessPool(unittest.TestCase):
+    def test_run_terminates_slow_task(self):
+        process_pool = LazyProcessPool(1, 'test')
+        self.addCleanup(process_pool.terminate)
+
+        with self.assertRaises(TimeoutError):
+            process_pool.run(time.sleep, 30, timeout=0.5)
+
+        self.assertEqual(process_pool.run(abs, -1, timeout=30), 1)
+
+    def test_timeout_does_not_affect_other_tasks(self):
+        process_pool = LazyProcessPool(2, 'test')
+        self.addCleanup(process_pool.terminate)
+        results = []
+
+        def run_other_task():
+            try:
+                results.append(process_pool.run(time.sleep, 2, timeout=30))
+            except Exception as e:
+                results.append(e)
+
+        other_task = threading.Thread(target=run_other_task)
+        other_task.start()
+        with self.assertRaises(TimeoutError):
+            process_pool.run(time.sleep, 30, timeout=0.5)
+        other_task.join()
+
+        self.assertEqual(results, [None])
@@ -1,7 +1,15 @@
+import tempfile
 import unittest
 from datetime import datetime
+from unittest.mock import MagicMock, patch
 
-from mail import Email, ExchangeEmail, Attachment
+from exchangelib.errors import ErrorFolderNotFound, UnauthorizedError
+
+import mail
+import main
+from mail import Email, ExchangeEmail, Attachment, EWSEmailService, get_storable_content_type
+from publish import MailPublishService
+from state_store import LocalStateStore
 
 
 class TestMailModule(unittest.TestCase):
@@ -29,3 +37,244 @@ class TestMailModule(unittest.TestCase):
         attachment = Attachment(None, 'name', 'content_type', 'content_id', 'storage_bucket', 'storage_filename')
 
         self.assertEqual(attachment.name, 'name')
+
+    def test_storable_content_type(self):
+        """
+        Assert that octet-stream attachments are stored with their guessed content-type.
+        """
+        self.assertEqual(get_storable_content_type('invoice.pdf', 'application/pdf'), 'application/pdf')
+        self.assertEqual(get_storable_content_type('invoice.pdf', 'application/octet-stream'), 'application/pdf')
+        self.assertIsNone(get_storable_content_type('logo.png', 'image/png'))
+
+
+class TestEWSEmailService(unittest.TestCase):
+    def setUp(self):
+        mail._exchange_clients.clear()
+        self.addCleanup(mail._exchange_clients.clear)
+
+    def create_email_service(self, **kwargs):
+        with patch.object(EWSEmailService, 'initialize_exchange_client'), \
+                patch.object(EWSEmailService, 'exchange_client', create=True):
+            email_service = EWSEmailService('inbox@example.com', folder=None, **kwargs)
+        email_service.exchange_client = MagicMock()
+        return email_service
+
+    def create_email(self):
+        return ExchangeEmail('uuid', 'subject', 'sender', 'receiver',
+                             datetime.now(), datetime.now(), 'body', [], MagicMock())
+
+    def test_acknowledge_marks_as_read_without_batching(self):
+        email_service = self.create_email_service()
+        email = self.create_email()
+
+        email_service.acknowledge(email)
+
+        email.original_message.save.assert_called_once_with(update_fields=['is_read'])
+        email_service.exchange_client.bulk_update.assert_not_called()
+
+    def test_acknowledge_marks_batch_as_read(self):
+        email_service = self.create_email_service(mark_as_read_batch_size=2)
+        emails = [self.create_email(), self.create_email()]
+        email_service.exchange_client.bulk_update.return_value = [('id', 'changekey'), ValueError('failed')]
+
+        self.assertEqual(email_service.acknowledge(emails[0]), [])
+        email_service.exchange_client.bulk_update.assert_not_called()
+
+        self.assertEqual(email_service.acknowledge(emails[1]), [emails[1]])
+        email_service.exchange_client.bulk_update.assert_called_once()
+        self.assertEqual(email_service.flush_acknowledgements(), [])
+        for email in emails:
+            email.original_message.save.assert_not_called()
+
+    def test_stream_unread_emails_yields_fetched_emails(self):
+        email_service = self.create_email_service(look_ahead=1)
+        email_service.folder.unread_count = 3
+        email_service._iterate_unread_emails = MagicMock(return_value=iter(['first', 'second', 'third']))
+
+        self.assertEqual(list(email_service.stream_unread_emails()), ['first', 'second', 'third'])
+
+    def test_iterate_unread_emails_lists_ids_first(self):
+        """
+        Assert that the unread emails are listed before any is yielded, so marking them as read can't skip others,
+        and that emails read in the meantime are skipped.
+        """
+        email_service = self.create_email_service(page_size=1)
+        messages = {item_id: MagicMock(id=item_id, is_read=item_id == 'read', subject=item_id, attachments=[])
+                    for item_id in ['first', 'read', 'second']}
+        id_query = email_service.folder.filter.return_value.order_by.return_value.values_list.return_value
+        id_query.iterator.return_value = iter([(item_id, 'changekey') for item_id in messages])
+        email_service.exchange_client.fetch.side_effect = \
+            lambda ids, **kwargs: (messages[item_id] for item_id, _ in ids)
+
+        emails = email_service._iterate_unread_emails()
+        first_email = next(emails)
+        first_email.original_message.is_read = True
+
+        self.assertEqual([first_email.subject] + [email.subject for email in emails], ['first', 'second'])
+        email_service.folder.filter.assert_called_once_with(is_read=False)
+
+    def test_stream_unread_emails_raises_fetch_errors(self):
+        email_service = self.create_email_service(look_ahead=2)
+        email_service.folder.unread_count = 1
+        email_service._iterate_unread_emails = MagicMock(side_effect=ConnectionError('disconnected'))
+
+        with self.assertRaises(ConnectionError):
+            list(email_service.stream_unread_emails())
+
+    def test_stream_unread_emails_fetch_error_keeps_processed_emails(self):
+        """
+        Assert that the emails processed before the background fetch failed are published and marked as read.
+        """
+        email_service = self.create_email_service(look_ahead=1, mark_as_read_batch_size=10)
+        email_service.folder.unread_count = 3
+        emails = [self.create_email(), self.create_email()]
+        email_service.exchange_client.bulk_update.side_effect = lambda items, **kwargs: [('id', 'ck') for _ in items]
+
+        def iterate_unread_emails():
+            yield from emails
+            raise ConnectionError('disconnected')
+
+        email_service._iterate_unread_emails = iterate_unread_emails
+
+        with patch('google.cloud.pubsub_v1.PublisherClient') as publisher_client:
+            publish_service = MailPublishService('topic', None, batch_settings={'max_messages': 10})
+            with self.assertRaises(ConnectionError):
+                main.process_emails(None, publish_service, email_service, email_service.stream_unread_emails(),
+                                    'identifier', 'mailbox')
+
+        self.assertEqual(publisher_client.return_value.publish.return_value.result.call_count, 2)
+        updated_items = email_service.exchange_client.bulk_update.call_args.kwargs['items']
+        self.assertEqual([message for message, _ in updated_items], [email.original_message for email in emails])
+
+    def test_exchange_client_is_reused(self):
+        email_service = self.create_email_service(password='password')
+        folder = email_service.folder
+
+        with patch.object(EWSEmailService, 'initialize_exchange_client') as initialize_exchange_client:
+            reused_email_service = EWSEmailService('inbox@example.com', password='password')
+
+        initialize_exchange_client.assert_not_called()
+        self.assertIs(reused_email_service.folder, folder)
+        folder.refresh.assert_called_once()
+
+    def test_exchange_client_is_not_reused_with_other_credentials(self):
+        self.create_email_service(password='password')
+
+        with patch.object(EWSEmailService, 'initialize_exchange_client') as initialize_exchange_client, \
+                patch.object(EWSEmailService, 'exchange_client', create=True):
+            EWSEmailService('inbox@example.com', password='rotated')
+
+        initialize_exchange_client.assert_called_once()
+
+    def test_exchange_client_is_invalidated_on_authentication_error(self):
+        email_service = self.create_email_service(password='password')
+        email_service.folder.refresh.side_effect = UnauthorizedError('Invalid credentials')
+
+        with self.assertRaises(UnauthorizedError):
+            EWSEmailService('inbox@example.com', password='password')
+
+        self.assertEqual(mail._exchange_clients, {})
+
+    def test_exchange_client_is_invalidated_on_refresh_error(self):
+        email_service = self.create_email_service(password='password')
+        email_service.folder.refresh.side_effect = ErrorFolderNotFound('Folder not found')
+
+        with self.assertRaises(ErrorFolderNotFound):
+            EWSEmailService('inbox@example.com', password='password')
+
+        self.assertEqual(mail._exchange_clients, {})
+
+    def create_message(self, item_id, is_read=False):
+        return MagicMock(id=item_id, changekey='changekey', is_read=is_read, subject=item_id, attachments=[])
+
+    def sync_folder_items(self, messages, pages):
+        """
+        Patches SyncFolderItems to return the created items of the page of a sync state, where pages maps a sync
+        state to the item ids and the next sync state. An exception in messages takes the place of its change.
+
+        :return: the sync states that were synced from.
+        """
+        patcher = patch('mail.SyncFolderItems')
+        service = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        sync_states = []
+
+        def call(sync_state, max_changes_returned, **kwargs):
+            self.assertEqual(max_changes_returned, mail.SYNC_MAX_CHANGES)
+            sync_states.append(sync_state)
+            item_ids, service.sync_state = pages[sync_state]
+            service.includes_last_item_in_range = True
+            return (messages[item_id] if isinstance(messages[item_id], Exception) else ('create', messages[item_id])
+                    for item_id in item_ids)
+
+        service.call.side_effect = call
+        return sync_states
+
+    def test_sync_new_emails(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        state_store = LocalStateStore(directory.name)
+        email_service = self.create_email_service()
+        messages = {item_id: self.create_message(item_id, is_read=item_id == 'read')
+                    for item_id in ['first', 'second', 'read', 'third']}
+        messages['failed'] = ValueError('Item could not be retrieved')
+        email_service.exchange_client.fetch.side_effect = \
+            lambda ids, **kwargs: (messages[item_id] for item_id, _ in ids)
+        sync_states = self.sync_folder_items(messages, {None: (['first', 'failed', 'second', 'read'], '+'),
+                                                        '+': (['third'], '++')})
+
+        emails = list(email_service.sync_new_emails(state_store, 'sync/identifier'))
+        self.assertEqual([email.subject for email in emails], ['first', 'second'])
+
+        email_service.acknowledge(emails[0])
+        email_service.save_sync_state(state_store, 'sync/identifier')
+
+        emails = list(email_service.sync_new_emails(state_store, 'sync/identifier'))
+        self.assertEqual(sorted(email.subject for email in emails), ['second', 'third'])
+        self.assertEqual(sync_states, [None, '+'])
+
+    def test_sync_new_emails_skips_read_emails_without_saved_state(self):
+        """
+        Assert that emails that were acknowledged by a run that stopped before saving its sync state are not
+        yielded again.
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        state_store = LocalStateStore(directory.name)
+        email_service = self.create_email_service()
+        messages = {item_id: self.create_message(item_id) for item_id in ['first', 'second']}
+        email_service.exchange_client.fetch.side_effect = \
+            lambda ids, **kwargs: (messages[item_id] for item_id, _ in ids)
+        self.sync_folder_items(messages, {None: (['first', 'second'], '+')})
+
+        emails = list(email_service.sync_new_emails(state_store, 'sync/identifier'))
+        email_service.acknowledge(emails[0])
+
+        emails = list(email_service.sync_new_emails(state_store, 'sync/identifier'))
+        self.assertEqual([email.subject for email in emails], ['second'])
+
+    def test_email_uuid_is_stable(self):
+        """
+        Assert that an email gets the same uuid every time it is retrieved, and another email a different one.
+        """
+        email_service = self.create_email_service()
+        message = MagicMock(message_id='<message@example.com>', attachments=[])
+        other_message = MagicMock(message_id='<other@example.com>', attachments=[])
+
+        self.assertEqual(email_service._convert_message(message).uuid, email_service._convert_message(message).uuid)
+        self.assertNotEqual(email_service._convert_message(message).uuid,
+                            email_service._convert_message(other_message).uuid)
+
+    def test_fetch_emails_skips_read_emails(self):
+        """
+        Assert that emails that were marked as read since they were found are not yielded again.
+        """
+        email_service = self.create_email_service()
+        messages = {item_id: self.create_message(item_id, is_read=item_id == 'read') for item_id in ['unread', 'read']}
+        email_service.exchange_client.fetch.side_effect = \
+            lambda ids, **kwargs: (messages[item_id] for item_id, _ in ids)
+
+        emails = list(email_service.fetch_emails([('unread', 'changekey'), ('read', 'changekey')]))
+
+        self.assertEqual([email.subject for email in emails], ['unread'])
+        self.assertEqual(email_service.get_unacknowledged_items(), [('unread', 'changekey')])
@@ -0,0 +1,68 @@
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from requests.exceptions import ConnectionError
+
+import main
+from idempotency import IdempotencyStore
+from mail import Attachment, Email
+from state_store import LocalStateStore
+
+
+class TestIdempotencyStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.idempotency_store = IdempotencyStore(LocalStateStore(directory.name))
+
+    @staticmethod
+    def create_email():
+        attachments = [Attachment(None, 'file.pdf', 'application/pdf', 'content_id', None, None)]
+        return Email('uuid', 'subject', 'sender', 'receiver', datetime.now(), datetime.now(), 'body', attachments)
+
+    @staticmethod
+    def store_attachments(email, identifier):
+        email.attachments[0].storage_bucket = 'bucket'
+        email.attachments[0].storage_filename = 'path/file.pdf'
+
+    @patch('retry.api.time.sleep')
+    def test_retry_resumes_from_failed_stage(self, sleep):
+        """
+        Assert that a retry of publish_and_mark does not store the attachments again.
+        """
+        email = self.create_email()
+        storage_service = MagicMock()
+        storage_service.store_attachments.side_effect = self.store_attachments
+        publish_service = MagicMock()
+        publish_service.publish_email.side_effect = [ConnectionError('Connection reset'), None]
+
+        main.publish_and_mark(storage_service, publish_service, MagicMock(), email, 'identifier',
+                              self.idempotency_store.get_progress(email, 'identifier'))
+
+        storage_service.store_attachments.assert_called_once()
+        self.assertEqual(publish_service.publish_email.call_count, 2)
+
+    def test_next_run_skips_published_email(self):
+        """
+        Assert that an email that was published but not marked as read is only acknowledged by a next run.
+        """
+        email = self.create_email()
+        storage_service = MagicMock()
+        storage_service.store_attachments.side_effect = self.store_attachments
+        publish_service = MagicMock()
+        publish_service.publish_email.side_effect = lambda email, on_published, **kwargs: on_published(email)
+
+        main.publish_and_mark(storage_service, publish_service, MagicMock(), email, 'identifier',
+                              self.idempotency_store.get_progress(email, 'identifier'))
+
+        retrieved_again = self.create_email()
+        email_service = MagicMock()
+        main.publish_and_mark(storage_service, publish_service, email_service, retrieved_again, 'identifier',
+                              self.idempotency_store.get_progress(retrieved_again, 'identifier'))
+
+        storage_service.store_attachments.assert_called_once()
+        publish_service.publish_email.assert_called_once()
+        email_service.acknowledge.assert_called_once_with(retrieved_again)
+        self.assertEqual(retrieved_again.attachments[0].storage_filename, 'path/file.pdf')
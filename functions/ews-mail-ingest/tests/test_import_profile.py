@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import import_profile
+
+
+class TestImportProfile(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with open(os.path.join(directory.name, 'profiled_package.py'), 'w') as f:
+            f.write('import profiled_dependency\n')
+        with open(os.path.join(directory.name, 'profiled_dependency.py'), 'w') as f:
+            f.write('import time\ntime.sleep(0.05)\n')
+
+        sys.path.insert(0, directory.name)
+        self.addCleanup(sys.path.remove, directory.name)
+        for module in ('profiled_package', 'profiled_dependency'):
+            self.addCleanup(sys.modules.pop, module, None)
+
+        import_profile.get_profile(reset=True)
+        import_profile.enable()
+        self.addCleanup(import_profile.disable)
+
+    def test_nested_imports_are_timed_separately(self):
+        import profiled_package  # noqa: F401
+
+        import_profile.disable()
+        profile = {entry['module']: entry for entry in import_profile.get_profile(reset=True)['modules']}
+
+        self.assertGreaterEqual(profile['profiled_dependency']['self_seconds'], 0.05)
+        self.assertLess(profile['profiled_package']['self_seconds'], 0.05)
+        self.assertGreaterEqual(profile['profiled_package']['cumulative_seconds'], 0.05)
+
+    def test_loaded_modules_are_not_profiled(self):
+        import json  # noqa: F401
+
+        self.assertEqual(import_profile.get_profile()['modules'], [])
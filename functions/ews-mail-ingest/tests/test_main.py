@@ -0,0 +1,184 @@
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from exchangelib.errors import UnauthorizedError
+
+import main
+from mail import Email
+from metrics import metrics
+from publish import MailPublishService
+from .test_publish import create_request
+
+
+class TestHandler(unittest.TestCase):
+    def create_email(self, subject):
+        return Email('uuid', subject, 'sender', 'receiver', datetime.now(), datetime.now(), 'body', [])
+
+    def test_process_emails_concurrently(self):
+        """
+        Assert that every email is published before it is acknowledged.
+        """
+        emails = [self.create_email('subject {}'.format(i)) for i in range(10)]
+        email_service = MagicMock()
+
+        with patch('google.cloud.pubsub_v1.PublisherClient') as publisher_client, \
+                patch.object(main, 'PROCESSING_WORKERS', 3):
+            publisher = publisher_client.return_value
+            publish_service = MailPublishService('topic', create_request())
+            email_service.acknowledge.side_effect = \
+                lambda email: self.assertEqual(publisher.publish.return_value.result.called, True)
+
+            main.process_emails_concurrently(None, publish_service, email_service, iter(emails), 'identifier',
+                                             'mailbox')
+
+        self.assertEqual(publisher.publish.call_count, 10)
+        self.assertEqual(email_service.acknowledge.call_count, 10)
+
+    def test_process_emails_flushes_when_retrieving_fails(self):
+        """
+        Assert that the emails processed before retrieving the next email failed are published and acknowledged.
+        """
+        def retrieve_emails():
+            yield from [self.create_email('subject {}'.format(i)) for i in range(3)]
+            raise ConnectionError('Connection lost')
+
+        email_service = MagicMock()
+
+        for processing_workers in (None, 2):
+            email_service.reset_mock()
+            with patch('google.cloud.pubsub_v1.PublisherClient') as publisher_client, \
+                    patch.object(main, 'PROCESSING_WORKERS', processing_workers):
+                publisher = publisher_client.return_value
+                publish_service = MailPublishService('topic', create_request(), batch_settings={'max_messages': 10})
+
+                with self.assertRaises(ConnectionError):
+                    main.process_emails(None, publish_service, email_service, retrieve_emails(), 'identifier',
+                                        'mailbox')
+
+            self.assertEqual(publisher.publish.return_value.result.call_count, 3)
+            self.assertEqual(email_service.acknowledge.call_count, 3)
+            email_service.flush_acknowledgements.assert_called_once()
+
+    def test_process_emails_reports_unacknowledged_emails(self):
+        """
+        Assert that emails that could not be marked as read are reported.
+        """
+        email = self.create_email('subject')
+        email_service = MagicMock()
+        email_service.acknowledge.return_value = []
+        email_service.flush_acknowledgements.return_value = [email]
+        started = metrics.snapshot()
+
+        with patch('google.cloud.pubsub_v1.PublisherClient'), self.assertLogs(level='ERROR') as logs:
+            main.process_emails(None, MailPublishService('topic', create_request()), email_service, [email],
+                                'identifier', 'mailbox')
+
+        self.assertEqual(metrics.summarize(started)['counters']['emails_unacknowledged'], 1)
+        self.assertIn('could not be marked as read', logs.output[0])
+
+    def test_process_email_forwards_failed_email(self):
+        """
+        Assert that an email that fails to publish is forwarded and acknowledged.
+        """
+        email = self.create_email('subject')
+        email.forward = MagicMock()
+        publish_service = MagicMock()
+        publish_service.publish_email.side_effect = ValueError('publish failed')
+        email_service = MagicMock()
+
+        with patch.object(main, 'ERROR_EMAIL_ADDRESS', 'error@example.com'):
+            main.process_email(None, publish_service, email_service, email, 'identifier', 'mailbox')
+
+        email.forward.assert_called_once()
+        email_service.acknowledge.assert_called_once_with(email)
+
+    @patch('main.invalidate_secret')
+    @patch('main.get_secret', return_value='password')
+    @patch('main.EWSEmailService')
+    def test_create_email_service_refreshes_secret(self, email_service, get_secret, invalidate_secret):
+        """
+        Assert that the cached password is invalidated when the mailbox can't be authenticated.
+        """
+        email_service.side_effect = [UnauthorizedError('Invalid credentials'), 'email_service']
+
+        self.assertEqual(main.create_email_service({'email': 'inbox@example.com', 'secret_id': 'secret'}),
+                         'email_service')
+        invalidate_secret.assert_called_once_with(main.PROJECT_ID, 'secret')
+        self.assertEqual(get_secret.call_count, 2)
+
+    def test_get_group_identifiers(self):
+        with patch.object(main, 'MAILBOX_GROUPS', {'group': ['a', 'b', 'c', 'd', 'e']}):
+            self.assertEqual(main.get_group_identifiers('group'), ['a', 'b', 'c', 'd', 'e'])
+            self.assertEqual(main.get_group_identifiers('group', 1, 2), ['b', 'd'])
+
+            with self.assertRaises(ValueError):
+                main.get_group_identifiers('unknown')
+
+    def test_parse_shard(self):
+        self.assertEqual(main.parse_shard(), (None, None))
+        self.assertEqual(main.parse_shard(None, '2'), (0, 2))
+        self.assertEqual(main.parse_shard('1', '2'), (1, 2))
+
+        for shard, shards in [('0', '0'), ('2', '2'), ('-1', '2'), ('a', '2'), ('1', None)]:
+            with self.assertRaises(ValueError):
+                main.parse_shard(shard, shards)
+
+    @patch('main.process_mailboxes')
+    def test_handler_rejects_invalid_shard(self, process_mailboxes):
+        request = create_request()
+        request.args = {'group': 'group', 'shards': '0'}
+
+        with patch.object(main, 'MAILBOX_GROUPS', {'group': ['a', 'b']}):
+            self.assertEqual(main.handler(request)[1], 400)
+
+        process_mailboxes.assert_not_called()
+
+    @patch('main.process_mailbox')
+    def test_process_mailboxes_isolates_errors(self, process_mailbox):
+        """
+        Assert that an error in one mailbox does not stop the other mailboxes from being processed.
+        """
+        process_mailbox.side_effect = lambda identifier, *args, **kwargs: 1 / (identifier != 'broken')
+
+        with patch.object(main, 'MAILBOX_CONCURRENCY', 2):
+            main.process_mailboxes(['first', 'broken', 'last'], create_request(), None, MagicMock())
+
+        self.assertEqual(sorted(call.args[0] for call in process_mailbox.call_args_list), ['broken', 'first', 'last'])
+
+    def test_take_until_deadline(self):
+        emails = (self.create_email('subject {}'.format(i)) for i in range(3))
+
+        self.assertEqual(list(main.take_until(emails, 0, 'mailbox')), [])
+        with self.assertRaises(StopIteration):
+            next(emails)
+
+    @patch('main.time')
+    def test_take_until_cost_estimate_exceeds_time_left(self, time):
+        """
+        Assert that no new email is taken when the time left can't cover the estimated cost of one more.
+        """
+        time.monotonic.side_effect = [0, 4, 8]
+        emails = iter([self.create_email('subject {}'.format(i)) for i in range(3)])
+        cost_estimate = main.EmailCostEstimate(1, weight=1)
+
+        self.assertEqual(len(list(main.take_until(emails, 10, 'mailbox', cost_estimate))), 2)
+        self.assertEqual(cost_estimate.seconds, 4)
+
+    @patch('main.create_email_service')
+    def test_process_mailbox_reports_deferred_emails(self, create_email_service):
+        """
+        Assert that a mailbox whose deadline has passed takes no emails, flushes and reports the deferred emails.
+        """
+        email_service = create_email_service.return_value
+        email_service.look_ahead = None
+        email_service.retrieve_unread_emails.return_value = [self.create_email('subject')]
+        email_service.count_deferred_emails.return_value = 1
+
+        with patch.object(main, 'EMAIL_ADDRESSES', {'identifier': {'email': 'inbox@example.com'}}), \
+                patch('google.cloud.pubsub_v1.PublisherClient'):
+            deferred = main.process_mailbox('identifier', create_request(), None, deadline=0)
+
+        self.assertEqual(deferred, 1)
+        email_service.acknowledge.assert_not_called()
+        email_service.flush_acknowledgements.assert_called_once()
@@ -0,0 +1,51 @@
+import io
+import os
+import time
+import unittest
+from threading import Thread
+
+from storage.memory import ByteSemaphore, spool_file
+
+
+class TestAttachmentMemory(unittest.TestCase):
+    def test_small_file_is_spooled_in_memory(self):
+        spooled_file, size = spool_file(io.BytesIO(b'x' * 100), max_memory_bytes=100, read_size=30)
+
+        self.assertIsInstance(spooled_file, io.BytesIO)
+        self.assertEqual((spooled_file.read(), size), (b'x' * 100, 100))
+
+    def test_large_file_is_spooled_to_named_file(self):
+        data = bytes(range(256)) * 4
+        spooled_file, size = spool_file(io.BytesIO(data), max_memory_bytes=100, read_size=30)
+
+        with spooled_file:
+            self.assertTrue(os.path.exists(spooled_file.name))
+            self.assertEqual((spooled_file.read(), size), (data, len(data)))
+        self.assertFalse(os.path.exists(spooled_file.name))
+
+    def test_spooling_stops_after_limit(self):
+        spooled_file, size = spool_file(io.BytesIO(b'x' * 100), max_memory_bytes=100, limit=10, read_size=30)
+
+        self.assertEqual(size, 11)
+
+    def test_byte_semaphore_is_acquired_in_order(self):
+        semaphore = ByteSemaphore(100)
+        acquired = []
+
+        # The whole capacity is taken by a size larger than the capacity.
+        self.assertEqual(semaphore.acquire(150), 100)
+
+        threads = [Thread(target=lambda size=size: acquired.append(semaphore.acquire(size))) for size in (80, 10)]
+        for tickets, thread in enumerate(threads, start=2):
+            thread.start()
+            # Waits until the thread has queued its acquisition.
+            while semaphore._next_ticket < tickets:
+                time.sleep(0.01)
+        self.assertEqual(acquired, [])
+
+        semaphore.release(100)
+        for thread in threads:
+            thread.join()
+
+        # The small acquisition could have fit earlier, but doesn't overtake the large one.
+        self.assertEqual(acquired, [80, 10])
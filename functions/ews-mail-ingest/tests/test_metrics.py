@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import main
+from metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_summarize_since_snapshot(self):
+        self.metrics.observe('upload', 1.5)
+        self.metrics.increment('attachments_cleaned', content_type='application/pdf')
+        snapshot = self.metrics.snapshot()
+
+        self.metrics.observe('upload', 0.5)
+        self.metrics.increment('attachments_cleaned', content_type='application/pdf')
+        self.metrics.increment('bytes_uploaded', 1024)
+
+        self.assertEqual(self.metrics.summarize(snapshot), {
+            'stages': {'upload': {'count': 1, 'seconds': 0.5}},
+            'counters': {'attachments_cleaned{content_type=application/pdf}': 1, 'bytes_uploaded': 1024},
+            'gauges': {},
+        })
+
+    def test_time_iterator_times_every_item(self):
+        items = list(self.metrics.time_iterator(iter(['first', 'second']), 'fetch'))
+
+        self.assertEqual(items, ['first', 'second'])
+        self.assertEqual(self.metrics.summarize()['stages']['fetch']['count'], 3)
+
+    def test_openmetrics_text(self):
+        self.metrics.observe('clean', 2, content_type='application/pdf')
+        self.metrics.increment('emails', result='processed')
+        self.metrics.set_gauge('ews_request_rate', 5.0, tenant='example.com')
+
+        self.assertEqual(self.metrics.to_openmetrics(), '\n'.join([
+            '# TYPE ews_mail_ingest_stage_seconds summary',
+            '# UNIT ews_mail_ingest_stage_seconds seconds',
+            'ews_mail_ingest_stage_seconds_count{stage="clean",content_type="application/pdf"} 1',
+            'ews_mail_ingest_stage_seconds_sum{stage="clean",content_type="application/pdf"} 2.0',
+            '# TYPE ews_mail_ingest_emails counter',
+            'ews_mail_ingest_emails_total{result="processed"} 1',
+            '# TYPE ews_mail_ingest_ews_request_rate gauge',
+            'ews_mail_ingest_ews_request_rate{tenant="example.com"} 5.0',
+            '# EOF',
+        ]) + '\n')
+
+    def test_write_openmetrics(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'metrics.txt')
+
+        self.metrics.write_openmetrics(path)
+
+        with open(path) as f:
+            self.assertEqual(f.read(), '# EOF\n')
+
+    def test_handler_returns_metrics(self):
+        request = MagicMock(args={'metrics': ''})
+
+        body, status, headers = main.handler(request)
+
+        self.assertEqual(status, 200)
+        self.assertTrue(body.endswith('# EOF\n'))
+        self.assertTrue(headers['Content-Type'].startswith('application/openmetrics-text'))
@@ -0,0 +1,114 @@
+import json
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from mail import Email
+import publish
+from publish import MailPublishService
+
+
+def create_request():
+    request = MagicMock()
+    request.data = b'{}'
+    request.headers = {}
+    return request
+
+
+def create_email(subject='subject', body='<b>body</b>'):
+    return Email('uuid', subject, 'sender', 'receiver', datetime.now(), datetime.now(), body, [])
+
+
+class TestMailPublishService(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('google.cloud.pubsub_v1.PublisherClient')
+        self.publisher_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publisher = self.publisher_client.return_value
+
+    def published_messages(self):
+        return [json.loads(call.args[1]) for call in self.publisher.publish.call_args_list]
+
+    def test_publish_email(self):
+        """
+        Assert that an email is published and acknowledged straight away without batch settings.
+        """
+        on_published = MagicMock()
+        email = create_email()
+
+        MailPublishService('topic', create_request()).publish_email(email, on_published=on_published)
+
+        self.publisher.publish.return_value.result.assert_called_once()
+        on_published.assert_called_once_with(email)
+        self.assertEqual(self.published_messages()[0]['email']['body'], '<b>body</b>')
+
+    def test_parse_html_content(self):
+        """
+        Assert that HTML is sanitized with the given tags.
+        """
+        publish_service = MailPublishService('topic', create_request())
+
+        self.assertEqual(publish_service.parse_html_content('<b>body</b><i>text</i>', ['b']), '<b>body</b>text')
+
+    def test_publish_email_in_batches(self):
+        """
+        Assert that batched emails are only acknowledged when flushed, and failures are reported per email.
+        """
+        succeeded, failed = MagicMock(), MagicMock()
+        failed.result.side_effect = TimeoutError('publish failed')
+        self.publisher.publish.side_effect = [succeeded, failed]
+        on_published = MagicMock()
+        emails = [create_email('first'), create_email('second')]
+
+        publish_service = MailPublishService('topic', create_request(), batch_settings={'max_messages': 2})
+        with self.assertLogs(level='INFO') as logs:
+            for email in emails:
+                publish_service.publish_email(email, on_published=on_published)
+
+        on_published.assert_not_called()
+        self.assertTrue(publish_service.should_flush())
+        self.assertFalse(any('Published' in line for line in logs.output))
+
+        with self.assertLogs(level='INFO') as logs:
+            failures = publish_service.flush()
+        self.assertEqual(len([line for line in logs.output if 'Published' in line]), 1)
+
+        on_published.assert_called_once_with(emails[0])
+        self.assertEqual([email for email, _ in failures], [emails[1]])
+        self.assertFalse(publish_service.should_flush())
+
+    def test_publish_email_offloads_large_body(self):
+        """
+        Assert that a body over BODY_OFFLOAD_SIZE is replaced by a reference to the stored body.
+        """
+        storage_service = MagicMock()
+        storage_service.store_body.return_value = {'bucket': 'bucket', 'full_path': 'identifier/uuid.body.html'}
+        email = create_email(body='<b>{}</b>'.format('a' * 100))
+
+        with patch.object(publish, 'BODY_OFFLOAD_SIZE', 50), patch.object(publish, 'BODY_OFFLOAD_COMPRESSION', 'gzip'):
+            publish_service = MailPublishService('topic', create_request())
+            publish_service.publish_email(email, storage_service=storage_service, identifier='identifier')
+            publish_service.publish_email(create_email(), storage_service=storage_service, identifier='identifier')
+
+        storage_service.store_body.assert_called_once_with(email, email.body, 'identifier', 'gzip')
+        offloaded, inline = [message['email'] for message in self.published_messages()]
+        self.assertIsNone(offloaded['body'])
+        self.assertEqual(offloaded['body_reference'], storage_service.store_body.return_value)
+        self.assertEqual(inline['body'], '<b>body</b>')
+        self.assertNotIn('body_reference', inline)
+
+    def test_publish_email_without_body_when_offloading(self):
+        """
+        Assert that an email without a body is published without storing a body when offloading is on.
+        """
+        storage_service = MagicMock()
+
+        with patch.object(publish, 'BODY_OFFLOAD_SIZE', 0):
+            MailPublishService('topic', create_request()).publish_email(create_email(body=None),
+                                                                        storage_service=storage_service,
+                                                                        identifier='identifier')
+
+        storage_service.store_body.assert_not_called()
+        message = self.published_messages()[0]['email']
+        self.assertIsNone(message['body'])
+        self.assertNotIn('body_reference', message)
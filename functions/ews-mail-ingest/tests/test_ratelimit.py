@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import patch
+
+from ratelimit import AdaptiveRateLimiter, RateLimitedRetryPolicy, ThrottledError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch('ratelimit.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.rate_limiter = AdaptiveRateLimiter('example.com', max_rate=2, min_rate=0.5, increase=0.5, decrease=0.5,
+                                                max_wait=10)
+
+    def test_acquire_paces_requests(self):
+        for _ in range(6):
+            self.rate_limiter.acquire()
+
+        # The first two requests are sent as a burst, the others at 2 requests per second.
+        self.assertEqual(self.clock.now, 2)
+
+    def test_back_off_decreases_rate_and_pauses(self):
+        self.rate_limiter.back_off(5)
+
+        self.assertEqual(self.rate_limiter.rate, 1)
+        self.rate_limiter.acquire()
+        self.assertEqual(self.clock.now, 5)
+
+    def test_rate_recovers_without_throttling(self):
+        self.rate_limiter.back_off()
+        self.rate_limiter.back_off()
+        self.assertEqual(self.rate_limiter.rate, 0.5)
+
+        self.clock.now += 2
+
+        self.assertEqual(self.rate_limiter.rate, 1.5)
+
+    def test_acquire_raises_when_wait_exceeds_max_wait(self):
+        self.rate_limiter.back_off(60)
+
+        with self.assertRaises(ThrottledError):
+            self.rate_limiter.acquire()
+        self.assertEqual(self.clock.now, 0)
+
+    def test_retry_policy_gates_requests(self):
+        """
+        Assert that exchangelib's back-off hook acquires a token and forwards server back-off hints to the limiter.
+        """
+        retry_policy = RateLimitedRetryPolicy(self.rate_limiter)
+
+        self.assertIsNone(retry_policy.back_off_until)
+        retry_policy.back_off(3)
+        self.assertIsNone(retry_policy.back_off_until)
+
+        self.assertEqual(self.clock.now, 3)
+        self.assertFalse(retry_policy.fail_fast)
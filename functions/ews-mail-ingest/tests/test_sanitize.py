@@ -0,0 +1,31 @@
+import unittest
+from unittest.mock import patch
+
+import sanitize
+from process_pool import LazyProcessPool
+from sanitize import BODY_TAGS, SUBJECT_TAGS, get_cleaner, sanitize_html
+
+
+class TestSanitize(unittest.TestCase):
+    def test_sanitize_subject(self):
+        self.assertEqual(sanitize_html('Invoice <b>123</b> & more', SUBJECT_TAGS), 'Invoice 123 &amp; more')
+
+    def test_sanitize_plain_subject_without_cleaner(self):
+        with patch.object(sanitize, 'get_cleaner') as cleaner:
+            self.assertEqual(sanitize_html('Invoice "123"', SUBJECT_TAGS), 'Invoice "123"')
+
+        cleaner.assert_not_called()
+
+    def test_sanitize_body(self):
+        self.assertEqual(sanitize_html('<b>body</b><script>alert(1)</script>', BODY_TAGS), '<b>body</b>alert(1)')
+
+    def test_cleaners_are_reused(self):
+        self.assertIs(get_cleaner(BODY_TAGS), get_cleaner(frozenset(BODY_TAGS)))
+
+    def test_sanitize_large_body_in_process_pool(self):
+        process_pool = LazyProcessPool(1, 'test')
+        self.addCleanup(process_pool.terminate)
+
+        with patch.object(sanitize, '_html_process_pool', process_pool), \
+                patch.object(sanitize, 'HTML_SANITIZE_OFFLOAD_SIZE', 10):
+            self.assertEqual(sanitize_html('<b>body</b><i>text</i>', BODY_TAGS), '<b>body</b><i>text</i>')
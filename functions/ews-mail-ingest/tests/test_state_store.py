@@ -0,0 +1,25 @@
+import tempfile
+import unittest
+
+from state_store import LocalStateStore
+
+
+class TestLocalStateStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.state_store = LocalStateStore(directory.name)
+
+    def test_save_and_load(self):
+        self.assertIsNone(self.state_store.load('sync/identifier'))
+
+        self.state_store.save('sync/identifier', {'sync_state': 'state'})
+
+        self.assertEqual(self.state_store.load('sync/identifier'), {'sync_state': 'state'})
+
+    def test_delete(self):
+        self.state_store.save('key', [1, 2])
+        self.state_store.delete('key')
+        self.state_store.delete('key')
+
+        self.assertIsNone(self.state_store.load('key'))
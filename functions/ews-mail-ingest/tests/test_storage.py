@@ -0,0 +1,165 @@
+import gzip
+import hashlib
+import io
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from mail import Attachment, Email
+from storage import email_attachment_storage
+from storage.base import GCSObjectStreamUpload, ObjectExistsError
+from storage.deduplication import AttachmentIndex
+from storage.email_attachment_storage import EmailAttachmentStorageService
+
+
+class TestEmailAttachmentStorageService(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('storage.base.storage.Client')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_email(self):
+        attachments = [Attachment(None, 'invoice-{}.pdf'.format(i), 'application/pdf', None, None, None)
+                       for i in range(5)]
+        attachments.append(Attachment(None, 'logo.png', 'image/png', None, None, None))
+        return Email('uuid', 'subject', 'sender', 'receiver', datetime.now(), datetime.now(), 'body', attachments)
+
+    def test_store_attachments_concurrently(self):
+        """
+        Assert that concurrently stored attachments get their storage location set.
+        """
+        email = self.create_email()
+        storage_service = EmailAttachmentStorageService('bucket')
+
+        with patch.object(email_attachment_storage, 'ATTACHMENT_UPLOAD_WORKERS', 3), \
+                patch.object(storage_service, '_store_file', side_effect=lambda file, filename, content_type: filename):
+            number_of_attachments = storage_service.store_attachments(email, 'identifier')
+
+        self.assertEqual(number_of_attachments, 5)
+        for attachment in email.attachments[:5]:
+            self.assertEqual(attachment.storage_bucket, 'bucket')
+            self.assertTrue(attachment.storage_filename.endswith('/uuid/' + attachment.name))
+        self.assertIsNone(email.attachments[5].storage_filename)
+
+    def test_store_body_compressed(self):
+        """
+        Assert that a body is stored gzip compressed and referred to by its uncompressed size and hash.
+        """
+        email = self.create_email()
+        storage_service = EmailAttachmentStorageService('bucket')
+        uploaded = []
+
+        def upload_file(fp, filename, content_type):
+            uploaded.append((filename, fp.read(), content_type))
+            raise ObjectExistsError()
+
+        with patch.object(storage_service, '_upload_file', side_effect=upload_file):
+            reference = storage_service.store_body(email, '<b>body</b>', 'identifier', 'gzip')
+
+        filename, data, content_type = uploaded[0]
+        self.assertEqual(gzip.decompress(data), b'<b>body</b>')
+        self.assertEqual(content_type, 'application/gzip')
+        self.assertTrue(filename.endswith('/uuid.body.html.gz'))
+        self.assertEqual(reference['full_path'], filename)
+        self.assertEqual(reference['size'], 11)
+        self.assertEqual(reference['sha256'], hashlib.sha256(b'<b>body</b>').hexdigest())
+
+    def test_store_file_renames_existing_object(self):
+        """
+        Assert that a file is stored under a unique name when an object with the same name already exists.
+        """
+        storage_service = EmailAttachmentStorageService('bucket')
+        uploaded = []
+
+        def upload_file(fp, filename, content_type):
+            uploaded.append((filename, fp.read()))
+            if len(uploaded) == 1:
+                raise ObjectExistsError()
+
+        with patch('storage.base.FileCleaner') as file_cleaner, \
+                patch.object(storage_service, '_upload_file', side_effect=upload_file):
+            file_cleaner.return_value.clean.return_value = io.BytesIO(b'content')
+            filename = storage_service._store_file(None, 'identifier/invoice.pdf', 'application/pdf')
+
+        self.assertEqual(uploaded[0], ('identifier/invoice.pdf', b'content'))
+        self.assertEqual(uploaded[1], (filename, b'content'))
+        self.assertRegex(filename, r'^identifier/invoice\.[0-9a-f-]{36}\.pdf$')
+
+
+class TestAttachmentDeduplication(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('storage.base.storage.Client')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def store_twice(self, deduplication):
+        storage_service = EmailAttachmentStorageService('bucket', deduplication=deduplication,
+                                                        attachment_index=AttachmentIndex())
+        uploaded = []
+
+        with patch('storage.base.FileCleaner') as file_cleaner, \
+                patch.object(storage_service, '_upload_file',
+                             side_effect=lambda fp, filename, content_type: uploaded.append(filename)):
+            file_cleaner.side_effect = lambda file, filename, content_type: MagicMock(clean=lambda: file)
+            filenames = [storage_service._store_file(io.BytesIO(b'content'), name, 'application/pdf')
+                         for name in ('first/terms.pdf', 'second/terms.pdf')]
+
+        return storage_service, filenames, uploaded
+
+    def test_reference_mode_references_stored_duplicate(self):
+        storage_service, filenames, uploaded = self.store_twice('reference')
+
+        self.assertEqual(uploaded, ['first/terms.pdf'])
+        self.assertEqual(filenames, ['first/terms.pdf', 'first/terms.pdf'])
+
+    def test_copy_mode_copies_stored_duplicate(self):
+        storage_service, filenames, uploaded = self.store_twice('copy')
+
+        self.assertEqual(uploaded, ['first/terms.pdf'])
+        self.assertEqual(filenames, ['first/terms.pdf', 'second/terms.pdf'])
+        bucket = storage_service.storage_client.bucket.return_value
+        self.assertEqual(bucket.copy_blob.call_args.args[2], 'second/terms.pdf')
+
+    def test_missing_duplicate_is_stored_again(self):
+        with patch('storage.base.storage.Client') as client:
+            client.return_value.bucket.return_value.blob.return_value.exists.return_value = False
+            storage_service, filenames, uploaded = self.store_twice('reference')
+
+        self.assertEqual(uploaded, ['first/terms.pdf', 'second/terms.pdf'])
+        self.assertEqual(filenames, ['first/terms.pdf', 'second/terms.pdf'])
+
+
+class TestGCSObjectStreamUpload(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('storage.base.AuthorizedSession')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data, chunk_size, write_size):
+        with GCSObjectStreamUpload(MagicMock(), 'bucket', 'blob', 'application/pdf', chunk_size=chunk_size) as f:
+            for i in range(0, len(data), write_size):
+                f.write(data[i:i + write_size])
+
+    @patch('storage.base.requests')
+    def test_small_file_is_uploaded_in_single_request(self, requests):
+        self.upload(b'x' * 1000, chunk_size=1024, write_size=100)
+
+        requests.ResumableUpload.assert_not_called()
+        transmit = requests.MultipartUpload.return_value.transmit
+        self.assertEqual(transmit.call_args.kwargs['data'], b'x' * 1000)
+        self.assertIn('ifGenerationMatch=0', requests.MultipartUpload.call_args.kwargs['upload_url'])
+
+    @patch('storage.base.requests')
+    def test_large_file_is_uploaded_in_chunks(self, requests):
+        data = bytes(range(256)) * 10
+        chunks = []
+        requests.ResumableUpload.return_value.initiate.side_effect = \
+            lambda stream, **kwargs: setattr(self, 'stream', stream)
+        requests.ResumableUpload.return_value.transmit_next_chunk.side_effect = \
+            lambda transport: chunks.append(self.stream.read(1024))
+
+        self.upload(data, chunk_size=1024, write_size=100)
+
+        requests.MultipartUpload.assert_not_called()
+        self.assertEqual([len(chunk) for chunk in chunks], [1024, 1024, 512])
+        self.assertEqual(b''.join(chunks), data)
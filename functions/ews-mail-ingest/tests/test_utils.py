@@ -0,0 +1,44 @@
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from utils import SecretCache
+
+
+class TestSecretCache(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('google.cloud.secretmanager.SecretManagerServiceClient')
+        self.client_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = self.client_class.return_value
+        self.versions = iter(range(100))
+        self.client.access_secret_version.side_effect = lambda request: MagicMock(
+            payload=MagicMock(data='secret-{}'.format(next(self.versions)).encode('UTF-8')))
+
+    def test_get_caches_secret(self):
+        cache = SecretCache(ttl=60, refresh_ratio=0.8)
+
+        self.assertEqual(cache.get('name'), 'secret-0')
+        self.assertEqual(cache.get('name'), 'secret-0')
+        self.client_class.assert_called_once()
+        self.client.access_secret_version.assert_called_once_with(request={'name': 'name'})
+
+    def test_get_refreshes_secret_in_background(self):
+        cache = SecretCache(ttl=60, refresh_ratio=0)
+
+        cache.get('name')
+        self.assertEqual(cache.get('name'), 'secret-0')
+
+        for _ in range(100):
+            if cache.get('name') == 'secret-1':
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.get('name'), 'secret-1')
+
+    def test_invalidate(self):
+        cache = SecretCache(ttl=60, refresh_ratio=0.8)
+
+        cache.get('name')
+        cache.invalidate('name')
+
+        self.assertEqual(cache.get('name'), 'secret-1')
@@ -0,0 +1,106 @@
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import worker
+from state_store import LocalStateStore
+from worker import MailboxWorker, NotificationSource
+
+EMAIL_ADDRESSES = {'identifier': {'email': 'mailbox@example.com'}}
+
+
+class FakeNotificationSource(NotificationSource):
+    """
+    Returns the given batches of item ids, where an exception in place of a batch simulates a disconnect.
+    """
+
+    def __init__(self, batches, on_exhausted):
+        self.batches = list(batches)
+        self.on_exhausted = on_exhausted
+        self.subscribed_watermarks = []
+
+    def subscribe(self, watermark=None):
+        self.subscribed_watermarks.append(watermark)
+        self.watermark = watermark or 'initial'
+        return watermark is not None
+
+    def get_new_item_ids(self):
+        if not self.batches:
+            self.on_exhausted()
+            return [], self.watermark
+
+        batch = self.batches.pop(0)
+        if isinstance(batch, Exception):
+            raise batch
+
+        item_ids, self.watermark = batch
+        return item_ids, self.watermark
+
+    def unsubscribe(self):
+        pass
+
+
+@patch.object(worker, 'EMAIL_ADDRESSES', EMAIL_ADDRESSES)
+@patch.object(worker, 'WORKER_POLL_INTERVAL', 0)
+@patch.object(worker, 'WORKER_RECONNECT_DELAY', 0)
+class TestMailboxWorker(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.state_store = LocalStateStore(directory.name)
+
+        self.email_service = MagicMock()
+        self.email_service.retrieve_unread_emails.return_value = []
+        self.email_service.fetch_emails.side_effect = lambda item_ids: ['email ' + item_id for item_id, _ in item_ids]
+        self.email_service.get_unacknowledged_items.return_value = []
+
+    def run_worker(self, batches):
+        processed = []
+        source = FakeNotificationSource(batches, lambda: mailbox_worker.stop())
+        mailbox_worker = MailboxWorker('identifier', notification_source_factory=lambda folder: source,
+                                       state_store=self.state_store, publisher=MagicMock())
+
+        with patch('worker.create_email_service', return_value=self.email_service), \
+                patch('worker.process_emails',
+                      side_effect=lambda storage, publish, email_service, emails, *args: processed.extend(emails)):
+            mailbox_worker.run()
+
+        return source, processed
+
+    def test_resubscribes_from_watermark_after_disconnect(self):
+        """
+        Assert that the worker resubscribes from the watermark of the last processed items after a disconnect.
+        """
+        source, processed = self.run_worker([
+            ([('id-1', 'ck-1')], 'watermark-1'),
+            ConnectionError('Connection lost'),
+            ([('id-2', 'ck-2')], 'watermark-2'),
+        ])
+
+        self.assertEqual(source.subscribed_watermarks, [None, 'watermark-1'])
+        self.assertEqual(processed, ['email id-1', 'email id-2'])
+        self.assertEqual(self.state_store.load('watermark/identifier'),
+                         {'watermark': 'watermark-2', 'unacknowledged_items': []})
+
+    def test_catches_up_when_not_resumed(self):
+        """
+        Assert that unread emails are processed when there is no watermark to resume from.
+        """
+        self.email_service.retrieve_unread_emails.return_value = ['unread email']
+
+        source, processed = self.run_worker([])
+
+        self.assertEqual(processed, ['unread email'])
+
+    def test_retries_unacknowledged_items_after_restart(self):
+        """
+        Assert that a restarted worker resumes from the saved watermark and retries unacknowledged emails.
+        """
+        self.state_store.save('watermark/identifier',
+                              {'watermark': 'watermark-1', 'unacknowledged_items': [['id-1', 'ck-1']]})
+
+        source, processed = self.run_worker([])
+
+        self.assertEqual(source.subscribed_watermarks, ['watermark-1'])
+        self.email_service.retrieve_unread_emails.assert_not_called()
+        self.assertEqual(processed, ['email id-1'])
@@ -1,4 +1,77 @@
-from google.cloud import secretmanager
+import logging
+import time
+from threading import Lock, Thread
+
+import config
+
+# Number of seconds a secret is cached. Cached secrets are refreshed in the background
+# once SECRET_CACHE_REFRESH_RATIO of their lifetime has passed.
+SECRET_CACHE_TTL = getattr(config, 'SECRET_CACHE_TTL', 600)
+SECRET_CACHE_REFRESH_RATIO = getattr(config, 'SECRET_CACHE_REFRESH_RATIO', 0.8)
+
+
+class SecretCache:
+    """
+    Caches Secret Manager secrets for the lifetime of a (warm) function instance.
+    """
+
+    def __init__(self, ttl: float, refresh_ratio: float):
+        self._ttl = ttl
+        self._refresh_after = ttl * refresh_ratio
+        self._client = None
+        self._secrets = {}
+        self._refreshing = set()
+        self._lock = Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                # Imported on first use, mailboxes without secrets don't need the Secret Manager client.
+                from google.cloud import secretmanager
+
+                self._client = secretmanager.SecretManagerServiceClient()
+            return self._client
+
+    def _fetch(self, name: str) -> str:
+        secret = self._get_client().access_secret_version(request={"name": name})
+        payload = secret.payload.data.decode("UTF-8")
+
+        with self._lock:
+            self._secrets[name] = (payload, time.monotonic())
+        return payload
+
+    def _refresh(self, name: str):
+        try:
+            self._fetch(name)
+        except Exception:
+            logging.warning('Error refreshing secret {}'.format(name), exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def get(self, name: str) -> str:
+        with self._lock:
+            payload, fetched_at = self._secrets.get(name, (None, None))
+            age = time.monotonic() - fetched_at if fetched_at is not None else None
+
+            if age is not None and age < self._ttl:
+                if age >= self._refresh_after and name not in self._refreshing:
+                    self._refreshing.add(name)
+                    Thread(target=self._refresh, args=(name,), name='refresh-secret', daemon=True).start()
+                return payload
+
+        return self._fetch(name)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            self._secrets.pop(name, None)
+
+
+_secret_cache = SecretCache(SECRET_CACHE_TTL, SECRET_CACHE_REFRESH_RATIO)
+
+
+def _get_secret_name(project_id, secret_id):
+    return f"projects/{project_id}/secrets/{secret_id}/versions/latest"
 
 
 def get_secret(project_id, secret_id):
@@ -6,12 +79,12 @@ def get_secret(project_id, secret_id):
     Returns a Secret Manager secret.
     """
 
-    client = secretmanager.SecretManagerServiceClient()
+    return _secret_cache.get(_get_secret_name(project_id, secret_id))
 
-    secret_name = client.access_secret_version(
-        request={"name": f"projects/{project_id}/secrets/{secret_id}/versions/latest"}
-    )
 
-    payload = secret_name.payload.data.decode("UTF-8")
+def invalidate_secret(project_id, secret_id):
+    """
+    Removes a secret from the cache, so it is retrieved from Secret Manager again the next time it is used.
+    """
 
-    return payload
+    _secret_cache.invalidate(_get_secret_name(project_id, secret_id))
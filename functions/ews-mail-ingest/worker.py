@@ -0,0 +1,300 @@
+"""
+Long-running alternative to main.handler, which ingests emails within seconds of their
+arrival instead of on the next scheduled invocation.
+
+The worker holds an EWS pull subscription on the folder of each given mailbox and
+processes the new emails with the same store/publish/mark pipeline as main.handler.
+When the subscription is lost, it resubscribes from the last processed watermark.
+
+Usage: python worker.py <identifier> [<identifier> ...]
+"""
+import logging
+import signal
+import sys
+from threading import Event, Thread
+
+from exchangelib.errors import ErrorInvalidWatermark
+from exchangelib.properties import CreatedEvent
+
+import config
+from config import EMAIL_ADDRESSES, TOPIC_NAME
+from main import (
+    PUBSUB_BATCH_SETTINGS,
+    create_email_service,
+    get_storage_service,
+    process_emails,
+)
+from metrics import METRICS_FILE, metrics
+from publish import MailPublishService
+from state_store import get_state_store
+
+# Number of seconds between two polls for new events.
+WORKER_POLL_INTERVAL = getattr(config, "WORKER_POLL_INTERVAL", 5)
+# Number of seconds to wait before resubscribing after the subscription was lost.
+WORKER_RECONNECT_DELAY = getattr(config, "WORKER_RECONNECT_DELAY", 30)
+# Number of minutes after which Exchange removes a subscription that is not polled.
+WORKER_SUBSCRIPTION_TIMEOUT = getattr(config, "WORKER_SUBSCRIPTION_TIMEOUT", 10)
+
+
+class NotificationSource:
+    """
+    Notifies about the items that are created in a folder.
+    """
+
+    watermark = None
+
+    def subscribe(self, watermark=None) -> bool:
+        """
+        Subscribes to the folder, starting after the watermark when given.
+
+        :return: whether the subscription resumed from the watermark.
+        """
+        pass
+
+    def get_new_item_ids(self):
+        """
+        :return: the (id, changekey) pairs of the items that were created since the
+            previous call, and the watermark after them.
+        """
+        pass
+
+    def unsubscribe(self):
+        pass
+
+
+class EWSPullNotificationSource(NotificationSource):
+    def __init__(self, folder, timeout=WORKER_SUBSCRIPTION_TIMEOUT):
+        self._folder = folder
+        self._timeout = timeout
+        self._subscription_id = None
+
+    def subscribe(self, watermark=None) -> bool:
+        if watermark is not None:
+            try:
+                self._subscription_id, self.watermark = self._folder.subscribe_to_pull(
+                    event_types=[CreatedEvent.ELEMENT_NAME],
+                    watermark=watermark,
+                    timeout=self._timeout,
+                )
+                return True
+            except ErrorInvalidWatermark:
+                # Exchange only keeps the events of a limited period.
+                logging.warning("Watermark has expired, subscribing without it")
+
+        self._subscription_id, self.watermark = self._folder.subscribe_to_pull(
+            event_types=[CreatedEvent.ELEMENT_NAME], timeout=self._timeout
+        )
+        return False
+
+    def get_new_item_ids(self):
+        item_ids = {}
+
+        for notification in self._folder.get_events(
+            self._subscription_id, self.watermark
+        ):
+            for event in notification.events:
+                if event.watermark:
+                    self.watermark = event.watermark
+                if isinstance(event, CreatedEvent) and event.item_id is not None:
+                    item_ids[event.item_id.id] = (
+                        event.item_id.id,
+                        event.item_id.changekey,
+                    )
+
+        return list(item_ids.values()), self.watermark
+
+    def unsubscribe(self):
+        if self._subscription_id is not None:
+            self._folder.unsubscribe(self._subscription_id)
+            self._subscription_id = None
+
+
+class MailboxWorker:
+    """
+    Processes the new emails of a mailbox as they arrive, until stop() is called.
+
+    The watermark and the emails that were not acknowledged are saved in the state
+    store, if configured, so a restarted worker resumes where it stopped.
+    """
+
+    def __init__(
+        self,
+        identifier,
+        notification_source_factory=EWSPullNotificationSource,
+        state_store=None,
+        publisher=None,
+        stop_event: Event = None,
+    ):
+        credentials = EMAIL_ADDRESSES.get(identifier, None)
+
+        if credentials is None:
+            raise ValueError("No credentials found for given email address.")
+
+        self.identifier = identifier
+        self.credentials = credentials
+        self.mailbox = credentials.get("alias", credentials["email"])
+        self.state_store = state_store
+        self.state_key = "watermark/" + identifier
+        self.stop_event = stop_event or Event()
+
+        self._notification_source_factory = notification_source_factory
+        self._publisher = publisher
+        self._watermark = None
+        self._unacknowledged_items = []
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        self._load_checkpoint()
+
+        while not self.stop_event.is_set():
+            try:
+                self._run_subscription()
+            except Exception:
+                logging.error(
+                    "Subscription of mailbox {} was lost, resubscribing in {}s".format(
+                        self.mailbox, WORKER_RECONNECT_DELAY
+                    ),
+                    exc_info=True,
+                )
+                self.stop_event.wait(WORKER_RECONNECT_DELAY)
+
+    def _run_subscription(self):
+        email_service = create_email_service(self.credentials)
+        publish_service = MailPublishService(
+            TOPIC_NAME,
+            None,
+            batch_settings=PUBSUB_BATCH_SETTINGS,
+            publisher=self._publisher,
+        )
+        source = self._notification_source_factory(email_service.folder)
+
+        resumed = source.subscribe(self._watermark)
+        logging.info(
+            "Subscribed to mailbox {}{}".format(
+                self.mailbox, " from the last watermark" if resumed else ""
+            )
+        )
+
+        try:
+            if resumed:
+                # Emails that were not acknowledged before are retried once.
+                item_ids = self._unacknowledged_items
+            else:
+                # Catches up on the emails that arrived while there was no subscription,
+                # and on the emails that were not acknowledged before.
+                self._process(
+                    email_service,
+                    publish_service,
+                    email_service.retrieve_unread_emails(),
+                )
+                item_ids = []
+            watermark = source.watermark
+
+            while True:
+                if item_ids:
+                    self._process(
+                        email_service,
+                        publish_service,
+                        email_service.fetch_emails(item_ids),
+                    )
+                # Only moves past the items once they have been processed.
+                self._save_checkpoint(email_service, watermark)
+
+                if self.stop_event.wait(WORKER_POLL_INTERVAL):
+                    break
+
+                item_ids, watermark = source.get_new_item_ids()
+        finally:
+            try:
+                source.unsubscribe()
+            except Exception:
+                logging.warning(
+                    "Error unsubscribing from mailbox {}".format(self.mailbox),
+                    exc_info=True,
+                )
+
+    def _process(self, email_service, publish_service, emails):
+        process_emails(
+            get_storage_service(),
+            publish_service,
+            email_service,
+            emails,
+            self.identifier,
+            self.mailbox,
+        )
+
+        if METRICS_FILE:
+            metrics.write_openmetrics(METRICS_FILE)
+
+    def _load_checkpoint(self):
+        if self.state_store is None:
+            return
+
+        checkpoint = self.state_store.load(self.state_key) or {}
+        self._watermark = checkpoint.get("watermark", None)
+        self._unacknowledged_items = [
+            tuple(item) for item in checkpoint.get("unacknowledged_items", [])
+        ]
+
+    def _save_checkpoint(self, email_service, watermark):
+        unacknowledged_items = email_service.get_unacknowledged_items()
+        if (
+            watermark == self._watermark
+            and unacknowledged_items == self._unacknowledged_items
+        ):
+            return
+
+        self._watermark = watermark
+        self._unacknowledged_items = unacknowledged_items
+
+        if self.state_store is not None:
+            self.state_store.save(
+                self.state_key,
+                {
+                    "watermark": watermark,
+                    "unacknowledged_items": unacknowledged_items,
+                },
+            )
+
+
+def run_workers(identifiers):
+    """
+    Runs a MailboxWorker per identifier until SIGTERM or SIGINT is received.
+    """
+    state_store = get_state_store()
+    if state_store is None:
+        logging.warning(
+            "No STATE_BUCKET or STATE_DIRECTORY configured, a restarted worker will "
+            "not resume from its last watermark"
+        )
+
+    stop_event = Event()
+    workers = [
+        MailboxWorker(identifier, state_store=state_store, stop_event=stop_event)
+        for identifier in identifiers
+    ]
+
+    def stop(signum, frame):
+        logging.info("Stopping workers")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    threads = [
+        Thread(target=worker.run, name="worker-" + worker.identifier)
+        for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python worker.py <identifier> [<identifier> ...]")
+
+    run_workers(sys.argv[1:])